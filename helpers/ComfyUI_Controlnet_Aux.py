@@ -35,6 +35,44 @@ MODELS = {
 }
 
 
+# Controlnet preprocessor models are not included in the API JSON
+# We need to add them manually based on the nodes being used to
+# avoid them being downloaded automatically from elsewhere
+NODE_CLASS_MAPPING = {
+    # Depth
+    "MiDaS-NormalMapPreprocessor": "dpt_hybrid-midas-501f0c75.pt",
+    "MiDaS-DepthMapPreprocessor": "dpt_hybrid-midas-501f0c75.pt",
+    "Zoe-DepthMapPreprocessor": "ZoeD_M12_N.pt",
+    "LeReS-DepthMapPreprocessor": ["res101.pth", "latest_net_G.pth"],
+    "MeshGraphormer-DepthMapPreprocessor": [
+        "hrnetv2_w64_imagenet_pretrained.pth",
+        "graphormer_hand_state_dict.bin",
+    ],
+    # Segmentation
+    "BAE-NormalMapPreprocessor": "scannet.pt",
+    "OneFormer-COCO-SemSegPreprocessor": "150_16_swin_l_oneformer_coco_100ep.pth",
+    "OneFormer-ADE20K-SemSegPreprocessor": "250_16_swin_l_oneformer_ade20k_160k.pth",
+    "UniFormer-SemSegPreprocessor": "upernet_global_small.pth",
+    "SemSegPreprocessor": "upernet_global_small.pth",
+    "AnimeFace_SemSegPreprocessor": ["UNet.pth", "isnetis.ckpt"],
+    "SAMPreprocessor": "mobile_sam.pt",
+    # Line extractors
+    "AnimeLineArtPreprocessor": "netG.pth",
+    "HEDPreprocessor": "ControlNetHED.pth",
+    "FakeScribblePreprocessor": "ControlNetHED.pth",
+    "M-LSDPreprocessor": "mlsd_large_512_fp32.pth",
+    "PiDiNetPreprocessor": "table5_pidinet.pth",
+    "LineArtPreprocessor": ["sk_model.pth", "sk_model2.pth"],
+    "Manga2Anime_LineArt_Preprocessor": "erika.pth",
+    # Pose
+    "OpenposePreprocessor": [
+        "body_pose_model.pth",
+        "hand_pose_model.pth",
+        "facenet.pth",
+    ],
+}
+
+
 class ComfyUI_Controlnet_Aux:
     @staticmethod
     def models():
@@ -50,44 +88,9 @@ class ComfyUI_Controlnet_Aux:
             for key in MODELS
         }
 
-    # Controlnet preprocessor models are not included in the API JSON
-    # We need to add them manually based on the nodes being used to
-    # avoid them being downloaded automatically from elsewhere
     @staticmethod
     def node_class_mapping():
-        return {
-            # Depth
-            "MiDaS-NormalMapPreprocessor": "dpt_hybrid-midas-501f0c75.pt",
-            "MiDaS-DepthMapPreprocessor": "dpt_hybrid-midas-501f0c75.pt",
-            "Zoe-DepthMapPreprocessor": "ZoeD_M12_N.pt",
-            "LeReS-DepthMapPreprocessor": ["res101.pth", "latest_net_G.pth"],
-            "MeshGraphormer-DepthMapPreprocessor": [
-                "hrnetv2_w64_imagenet_pretrained.pth",
-                "graphormer_hand_state_dict.bin",
-            ],
-            # Segmentation
-            "BAE-NormalMapPreprocessor": "scannet.pt",
-            "OneFormer-COCO-SemSegPreprocessor": "150_16_swin_l_oneformer_coco_100ep.pth",
-            "OneFormer-ADE20K-SemSegPreprocessor": "250_16_swin_l_oneformer_ade20k_160k.pth",
-            "UniFormer-SemSegPreprocessor": "upernet_global_small.pth",
-            "SemSegPreprocessor": "upernet_global_small.pth",
-            "AnimeFace_SemSegPreprocessor": ["UNet.pth", "isnetis.ckpt"],
-            "SAMPreprocessor": "mobile_sam.pt",
-            # Line extractors
-            "AnimeLineArtPreprocessor": "netG.pth",
-            "HEDPreprocessor": "ControlNetHED.pth",
-            "FakeScribblePreprocessor": "ControlNetHED.pth",
-            "M-LSDPreprocessor": "mlsd_large_512_fp32.pth",
-            "PiDiNetPreprocessor": "table5_pidinet.pth",
-            "LineArtPreprocessor": ["sk_model.pth", "sk_model2.pth"],
-            "Manga2Anime_LineArt_Preprocessor": "erika.pth",
-            # Pose
-            "OpenposePreprocessor": [
-                "body_pose_model.pth",
-                "hand_pose_model.pth",
-                "facenet.pth",
-            ],
-        }
+        return NODE_CLASS_MAPPING
 
     @staticmethod
     def add_controlnet_preprocessor_weight(weights_to_download, node):
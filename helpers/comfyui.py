@@ -1,60 +1,279 @@
 import os
+import queue
 import urllib.request
 import subprocess
 import threading
 import time
 import json
 import urllib
-import uuid
 import json
 import os
-import websocket
 import random
+import hashlib
 from weights_downloader import WeightsDownloader
-from urllib.error import URLError
+from helpers.http_client import HTTPClient, HTTPError
+from helpers.timeline import Timeline
+from helpers.execution_cache import ExecutionCache
+from helpers.websocket_session import WebSocketSession
+from concurrent.futures import ThreadPoolExecutor
 
 # custom_nodes helpers
 from helpers.ComfyUI_IPAdapter_plus import ComfyUI_IPAdapter_plus
 from helpers.ComfyUI_Controlnet_Aux import ComfyUI_Controlnet_Aux
 
+SERVER_READY_LOG_LINE = "To see the GUI go to"
+
+# Where ComfyUI writes previews and other temporary outputs
+TEMP_DIRECTORY = "ComfyUI/temp"
+
+WEIGHTS_FILETYPES = (
+    ".ckpt",
+    ".safetensors",
+    ".pt",
+    ".pth",
+    ".bin",
+    ".onnx",
+    ".torchscript",
+)
+
+# Seconds a prompt may run, from when it starts executing, before it is
+# interrupted. 0 waits forever. Callers scale this with the work a prompt
+# does, see Predictor.prompt_timeout.
+PROMPT_TIMEOUT = float(os.environ.get("COMFYUI_PROMPT_TIMEOUT", 600))
+
+# Websocket messages that end a prompt without it finishing
+FAILURE_MESSAGE_TYPES = {"execution_error", "execution_interrupted"}
+
+# How many distinct workflows to remember resolved weights for
+MAX_RESOLVED_WEIGHTS = 32
+
+# Nodes whose outputs are the results of a workflow
+OUTPUT_NODE_CLASSES = {
+    "SaveImage",
+    "SaveAnimatedWEBP",
+    "SaveAnimatedPNG",
+    "VHS_VideoCombine",
+}
+
+# Output nodes that only show intermediate results, useful for debugging
+PREVIEW_NODE_CLASSES = {
+    "PreviewImage",
+    "MaskPreview+",
+}
+
+
+# Flattens the outputs from a prompt's history into a list of files, in a
+# deterministic order: by node id, then by position in the node's batch.
+def output_manifest(outputs, output_directory, input_directory, prompt_id=None):
+    directories = {
+        "output": output_directory,
+        "input": input_directory,
+        "temp": TEMP_DIRECTORY,
+    }
+    manifest = []
+    for node_id in sorted(outputs, key=lambda node_id: (len(node_id), node_id)):
+        for items in outputs[node_id].values():
+            if not isinstance(items, list):
+                continue
+            frame_index = 0
+            for item in items:
+                if not isinstance(item, dict) or "filename" not in item:
+                    continue
+                subfolder = item.get("subfolder", "")
+                output_type = item.get("type", "output")
+                manifest.append(
+                    {
+                        "prompt_id": prompt_id,
+                        "node_id": node_id,
+                        "filename": item["filename"],
+                        "subfolder": subfolder,
+                        "type": output_type,
+                        "frame_index": frame_index,
+                        "path": os.path.join(
+                            directories.get(output_type, output_directory),
+                            subfolder,
+                            item["filename"],
+                        ),
+                    }
+                )
+                frame_index += 1
+    return manifest
+
+
+def log_output_manifest(manifest):
+    print("outputs:")
+    for output in manifest:
+        print(
+            f"  {output['node_id']}[{output['frame_index']}] ({output['type']}): "
+            f"{os.path.join(output['subfolder'], output['filename'])}"
+        )
+
+
+# Raised when a prompt fails on the server, with the details ComfyUI sends
+# in its execution_error or execution_interrupted message
+class ComfyUIExecutionError(Exception):
+    def __init__(
+        self,
+        prompt_id,
+        node_id=None,
+        node_type=None,
+        exception_type=None,
+        exception_message=None,
+        traceback=None,
+        interrupted=False,
+    ):
+        self.prompt_id = prompt_id
+        self.node_id = node_id
+        self.node_type = node_type
+        self.exception_type = exception_type
+        self.exception_message = exception_message
+        self.traceback = traceback or []
+        self.interrupted = interrupted
+        super().__init__(self.describe())
+
+    @classmethod
+    def from_message(cls, message):
+        data = message.get("data", {})
+        return cls(
+            data.get("prompt_id"),
+            node_id=data.get("node_id"),
+            node_type=data.get("node_type"),
+            exception_type=data.get("exception_type"),
+            exception_message=data.get("exception_message"),
+            traceback=data.get("traceback"),
+            interrupted=message["type"] == "execution_interrupted",
+        )
+
+    def describe(self):
+        node = f"node {self.node_id} ({self.node_type})"
+        if self.interrupted:
+            return f"Prompt {self.prompt_id} was interrupted at {node}"
+        return (
+            f"Prompt {self.prompt_id} failed at {node}: "
+            f"{self.exception_type}: {self.exception_message}"
+        )
+
+
+# Raised when a prompt does not finish within its deadline. node_id is the
+# node that was executing, if any.
+class PromptTimeoutError(ComfyUIExecutionError):
+    def __init__(self, prompt_id, timeout, node_id=None, node_type=None):
+        self.timeout = timeout
+        super().__init__(prompt_id, node_id=node_id, node_type=node_type)
+
+    def describe(self):
+        if self.node_id is None:
+            return f"Prompt {self.prompt_id} did not finish within {self.timeout:g}s"
+        return (
+            f"Prompt {self.prompt_id} did not finish within {self.timeout:g}s, "
+            f"stuck at node {self.node_id} ({self.node_type})"
+        )
+
+
+# The message that ended a failed prompt, from its history entry
+def history_failure(entry):
+    for message_type, data in reversed(entry.get("status", {}).get("messages", [])):
+        if message_type in FAILURE_MESSAGE_TYPES:
+            return {"type": message_type, "data": data}
+    return None
+
+
+# Calls and messages made for a prediction are also counted on its trace
+def http_stats(trace):
+    return trace.http_stats if trace is not None else None
+
+
+def cache_stats(trace):
+    return trace.cache_stats if trace is not None else None
+
 
 class ComfyUI:
     def __init__(self, server_address):
         self.weights_downloader = WeightsDownloader()
         self.server_address = server_address
+        self.http = HTTPClient(server_address)
+        self.execution_cache = ExecutionCache(self.http)
+        self.ws_session = None
+        self.ws_session_lock = threading.Lock()
+        self.resolved_weights = {}
         ComfyUI_IPAdapter_plus.prepare()
 
-    def start_server(self, output_directory, input_directory):
+    # Starts ComfyUI as early as possible. If a workflow is given its weights
+    # are downloaded while the server is still importing, rather than before
+    # it starts.
+    def start_server(self, output_directory, input_directory, workflow=None):
         self.input_directory = input_directory
         self.output_directory = output_directory
+        timeline = Timeline("Setup")
 
-        self.download_pre_start_models()
+        with timeline.phase("Download pre-start models"):
+            self.download_pre_start_models()
 
-        server_thread = threading.Thread(
-            target=self.run_server, args=(output_directory, input_directory)
-        )
-        server_thread.start()
+        with timeline.phase("Launch server"):
+            self.launch_server(output_directory, input_directory)
 
-        start_time = time.time()
-        while not self.is_server_running():
-            if time.time() - start_time > 60:  # If more than a minute has passed
-                raise TimeoutError("Server did not start within 60 seconds")
-            time.sleep(1)  # Wait for 1 second before checking again
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            if workflow is not None:
+                weights = executor.submit(
+                    timeline.run,
+                    "Download workflow weights",
+                    self.load_workflow,
+                    workflow,
+                    handle_inputs=False,
+                )
+
+            with timeline.phase("Wait for server"):
+                self.wait_for_server()
+
+            if workflow is not None:
+                weights.result()
 
         print("Server running")
+        timeline.log()
+
+    def launch_server(self, output_directory, input_directory):
+        command = [
+            "python",
+            "./ComfyUI/main.py",
+            "--output-directory",
+            output_directory,
+            "--input-directory",
+            input_directory,
+        ] + self.execution_cache.launch_args()
+        self.server_ready = threading.Event()
+        self.server_process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+            env={**os.environ, "PYTHONUNBUFFERED": "1"},
+        )
+        threading.Thread(target=self.follow_server_log, daemon=True).start()
+
+    # Echo the server log and watch for the line ComfyUI prints once it is
+    # listening, so readiness is seen as soon as it happens
+    def follow_server_log(self):
+        for line in self.server_process.stdout:
+            print(line, end="")
+            if SERVER_READY_LOG_LINE in line:
+                self.server_ready.set()
 
-    def run_server(self, output_directory, input_directory):
-        command = f"python ./ComfyUI/main.py --output-directory {output_directory} --input-directory {input_directory}"
-        server_process = subprocess.Popen(command, shell=True)
-        server_process.wait()
+    def wait_for_server(self, timeout=60, poll_interval=0.05):
+        start_time = time.time()
+        while not (self.server_ready.wait(poll_interval) or self.is_server_running()):
+            if self.server_process.poll() is not None:
+                raise RuntimeError(
+                    f"Server exited with code {self.server_process.returncode} before it was ready"
+                )
+            if time.time() - start_time > timeout:
+                raise TimeoutError(f"Server did not start within {timeout} seconds")
 
     def is_server_running(self):
         try:
-            with urllib.request.urlopen(
-                "http://{}/history/{}".format(self.server_address, "123")
-            ) as response:
-                return response.status == 200
-        except URLError:
+            self.http.request("GET", "/history/123", name="is_server_running")
+            return True
+        except (OSError, HTTPError):
             return False
 
     def download_pre_start_models(self):
@@ -63,16 +282,26 @@ class ComfyUI:
 
     def handle_weights(self, workflow):
         print("Checking weights")
+        fingerprint = self.weights_fingerprint(workflow)
+        weights_to_download = self.resolved_weights.get(fingerprint)
+
+        if weights_to_download is None:
+            weights_to_download = self.resolve_weights(workflow)
+            if len(self.resolved_weights) >= MAX_RESOLVED_WEIGHTS:
+                self.resolved_weights.pop(next(iter(self.resolved_weights)))
+            self.resolved_weights[fingerprint] = weights_to_download
+        else:
+            print("Using weights already resolved for this workflow")
+
+        self.weights_downloader.download_weights_concurrently(weights_to_download)
+
+        for weight in weights_to_download:
+            print(f"✅ {weight}")
+
+        print("====================================")
+
+    def resolve_weights(self, workflow):
         weights_to_download = []
-        weights_filetypes = [
-            ".ckpt",
-            ".safetensors",
-            ".pt",
-            ".pth",
-            ".bin",
-            ".onnx",
-            ".torchscript",
-        ]
 
         for node in workflow.values():
             ComfyUI_Controlnet_Aux.add_controlnet_preprocessor_weight(
@@ -81,18 +310,26 @@ class ComfyUI:
 
             if "inputs" in node:
                 for input in node["inputs"].values():
-                    if isinstance(input, str) and any(
-                        input.endswith(ft) for ft in weights_filetypes
-                    ):
+                    if isinstance(input, str) and input.endswith(WEIGHTS_FILETYPES):
                         weights_to_download.append(input)
 
-        weights_to_download = list(set(weights_to_download))
+        return list(set(weights_to_download))
 
-        for weight in weights_to_download:
-            self.weights_downloader.download_weights(weight)
-            print(f"✅ {weight}")
+    # A hash of everything in the workflow that decides which weights it
+    # needs: node class types, weight filenames and preprocessor names.
+    # Prompts, seeds and images don't change it.
+    def weights_fingerprint(self, workflow):
+        parts = []
+        for node in workflow.values():
+            parts.append(str(node.get("class_type")))
+            for key, value in node.get("inputs", {}).items():
+                if isinstance(value, str) and (
+                    key == "preprocessor" or value.endswith(WEIGHTS_FILETYPES)
+                ):
+                    parts.append(f"{key}={value}")
 
-        print("====================================")
+        parts.sort()
+        return hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()
 
     def is_image_or_video_value(self, value):
         return isinstance(value, str) and any(
@@ -128,40 +365,168 @@ class ComfyUI:
 
         print("====================================")
 
+    # The websocket is opened once and reused by every prediction
     def connect(self):
-        self.client_id = str(uuid.uuid4())
-        self.ws = websocket.WebSocket()
-        self.ws.connect(f"ws://{self.server_address}/ws?clientId={self.client_id}")
-
-    def queue_prompt(self, prompt):
+        with self.ws_session_lock:
+            if self.ws_session and self.ws_session.is_alive():
+                return
+
+            self.ws_session = WebSocketSession(
+                self.server_address, on_reconnect=self.recover_prompts
+            ).start()
+            self.client_id = self.ws_session.client_id
+
+    # Completion messages may have been missed while the websocket was down,
+    # any prompt that has already finished is marked as done, or failed
+    def recover_prompts(self, prompt_ids):
+        for prompt_id in prompt_ids:
+            try:
+                history = self.http.get_json(
+                    f"/history/{prompt_id}", name="recover_prompts"
+                )
+            except (OSError, HTTPError) as e:
+                print(f"Could not check prompt {prompt_id} after reconnecting: {e}")
+                continue
+            if prompt_id in history:
+                self.ws_session.dispatch(
+                    history_failure(history[prompt_id])
+                    or {
+                        "type": "executing",
+                        "data": {"node": None, "prompt_id": prompt_id},
+                    }
+                )
+
+    def queue_prompt(self, prompt, trace=None):
         # Prompt is the loaded workflow (prompt is the label comfyUI uses)
+        prompt = self.execution_cache.apply_nonces(prompt)
         p = {"prompt": prompt, "client_id": self.client_id}
-        data = json.dumps(p).encode("utf-8")
-        req = urllib.request.Request(
-            f"http://{self.server_address}/prompt?{self.client_id}", data=data
+        output = self.http.post_json(
+            "/prompt", p, name="queue_prompt", stats=http_stats(trace)
         )
-
-        output = json.loads(urllib.request.urlopen(req).read())
         return output["prompt_id"]
 
-    def wait_for_prompt_completion(self, workflow, prompt_id):
+    def wait_for_prompt_completion(
+        self, workflow, prompt_id, trace=None, timeout=PROMPT_TIMEOUT
+    ):
+        messages = self.ws_session.subscribe()
+        self.ws_session.route(prompt_id, messages)
+        completed = False
+        try:
+            self.wait_for_any_prompt_completion(
+                workflow, {prompt_id}, messages, trace=trace, timeout=timeout
+            )
+            completed = True
+        except ComfyUIExecutionError as e:
+            # A prompt that failed has already stopped, only a timeout
+            # leaves it running
+            completed = not isinstance(e, PromptTimeoutError)
+            raise
+        finally:
+            self.ws_session.unroute(prompt_id)
+            if not completed:
+                self.cancel_prompts([prompt_id], trace)
+
+    # Blocks until one of the given prompts finishes and returns its id.
+    # The prompts must have been routed to the messages queue.
+    # Every message is recorded on the trace, if one is given.
+    def wait_for_any_prompt_completion(
+        self, workflow, prompt_ids, messages, trace=None, timeout=PROMPT_TIMEOUT
+    ):
+        for message in self.prompt_messages(
+            workflow, prompt_ids, messages, trace, timeout
+        ):
+            pass
+        return message["data"]["prompt_id"]
+
+    # Yields the messages for the given prompts as they arrive, until one of
+    # them finishes. The last message is that prompt's final executing message.
+    # Raises ComfyUIExecutionError if one of them fails, and PromptTimeoutError
+    # if none finishes within timeout seconds of starting to execute. Until
+    # one starts, the deadline counts from the call, so a stalled queue is
+    # also caught.
+    def prompt_messages(
+        self, workflow, prompt_ids, messages, trace=None, timeout=PROMPT_TIMEOUT
+    ):
+        deadline = time.monotonic() + timeout if timeout else None
+        running = None
+        current = None
         while True:
-            out = self.ws.recv()
-            if isinstance(out, str):
-                message = json.loads(out)
-                if message["type"] == "executing":
-                    data = message["data"]
-                    if data["node"] is None and data["prompt_id"] == prompt_id:
-                        break
-                    elif data["prompt_id"] == prompt_id:
-                        node = workflow.get(data["node"], {})
-                        meta = node.get("_meta", {})
-                        class_type = node.get("class_type", "Unknown")
-                        print(
-                            f"Executing node {data['node']}, title: {meta.get('title', 'Unknown')}, class type: {class_type}"
-                        )
-            else:
+            try:
+                message = messages.get(
+                    timeout=(
+                        max(0, deadline - time.monotonic())
+                        if deadline is not None
+                        else None
+                    )
+                )
+            except queue.Empty:
+                node = workflow.get(current, {})
+                raise PromptTimeoutError(
+                    running or next(iter(prompt_ids), None),
+                    timeout,
+                    node_id=current,
+                    node_type=node.get("class_type") if current else None,
+                )
+            if trace is not None:
+                trace.record(message)
+            data = message["data"]
+            if data.get("prompt_id") not in prompt_ids:
                 continue
+            self.execution_cache.record(message, workflow, cache_stats(trace))
+            if message["type"] in FAILURE_MESSAGE_TYPES:
+                error = ComfyUIExecutionError.from_message(message)
+                print(f"❌ {error}")
+                raise error
+            if message["type"] == "execution_start":
+                running = data["prompt_id"]
+                current = None
+                if timeout:
+                    deadline = time.monotonic() + timeout
+            yield message
+            if message["type"] == "executing":
+                running = data["prompt_id"]
+                current = data["node"]
+                if data["node"] is None:
+                    return
+                node = workflow.get(data["node"], {})
+                meta = node.get("_meta", {})
+                class_type = node.get("class_type", "Unknown")
+                print(
+                    f"Executing node {data['node']}, title: {meta.get('title', 'Unknown')}, class type: {class_type}"
+                )
+
+    # Removes the prompts from the server's queue, and interrupts whichever
+    # of them is running. Only prompts the server reports as running are
+    # interrupted, so a prompt from another prediction is not stopped.
+    def cancel_prompts(self, prompt_ids, trace=None):
+        prompt_ids = set(prompt_ids)
+        if not prompt_ids:
+            return
+        stats = http_stats(trace)
+        try:
+            server_queue = self.http.get_json("/queue", name="get_queue", stats=stats)
+            running = {item[1] for item in server_queue.get("queue_running", [])}
+            queued = prompt_ids - running
+            if queued:
+                self.http.post_json(
+                    "/queue",
+                    {"delete": sorted(queued)},
+                    name="delete_queued",
+                    stats=stats,
+                )
+            for prompt_id in prompt_ids & running:
+                self.http.post_json(
+                    "/interrupt",
+                    {"prompt_id": prompt_id},
+                    name="interrupt",
+                    stats=stats,
+                )
+        except (OSError, HTTPError, ValueError) as e:
+            print(f"Could not cancel prompts {sorted(prompt_ids)}: {e}")
+            return
+        print(
+            f"Cancelled {len(prompt_ids)} prompts, interrupted {len(prompt_ids & running)}"
+        )
 
     def load_workflow(self, workflow, handle_inputs=True):
         if not isinstance(workflow, dict):
@@ -182,6 +547,10 @@ class ComfyUI:
             self.handle_inputs(wf)
         return wf
 
+    # Call between predictions
+    def check_memory(self):
+        self.execution_cache.enforce_watermark(self.reset_execution_cache)
+
     # TODO: Find a better way of doing this
     # Nuclear reset
     def reset_execution_cache(self):
@@ -202,19 +571,241 @@ class ComfyUI:
             for seed_key in seed_keys:
                 self.randomise_input_seed(seed_key, inputs)
 
-    def run_workflow(self, workflow):
+    # Removes preview nodes, unless keep_previews is set, and every node
+    # that no remaining output node depends on. ComfyUI runs every output
+    # node it is given, so otherwise discarded previews still cost GPU time.
+    # Nodes in keep_nodes are kept, along with everything they depend on.
+    def optimize_workflow(self, workflow, keep_previews=False, keep_nodes=()):
+        roots = [
+            node_id
+            for node_id, node in workflow.items()
+            if node.get("class_type") in OUTPUT_NODE_CLASSES
+            or (keep_previews and node.get("class_type") in PREVIEW_NODE_CLASSES)
+            or node_id in keep_nodes
+        ]
+        if not any(
+            node.get("class_type") in OUTPUT_NODE_CLASSES for node in workflow.values()
+        ):
+            return workflow
+
+        reachable = set()
+        while roots:
+            node_id = roots.pop()
+            if node_id in reachable or node_id not in workflow:
+                continue
+            reachable.add(node_id)
+            for value in workflow[node_id].get("inputs", {}).values():
+                if (
+                    isinstance(value, list)
+                    and len(value) == 2
+                    and isinstance(value[0], str)
+                    and isinstance(value[1], int)
+                ):
+                    roots.append(value[0])
+
+        if len(reachable) == len(workflow):
+            return workflow
+
+        print(f"Pruned {len(workflow) - len(reachable)} of {len(workflow)} nodes")
+        return {
+            node_id: node for node_id, node in workflow.items() if node_id in reachable
+        }
+
+    def run_workflow(
+        self,
+        workflow,
+        optimize=False,
+        keep_previews=False,
+        keep_nodes=(),
+        trace=None,
+        timeout=PROMPT_TIMEOUT,
+    ):
+        manifest = sorted(
+            self.stream_workflow(
+                workflow, optimize, keep_previews, keep_nodes, trace, timeout
+            ),
+            key=lambda output: (
+                len(output["node_id"]),
+                output["node_id"],
+                output["frame_index"],
+            ),
+        )
+        self.log_output_manifest(manifest)
+        print("====================================")
+        return manifest
+
+    # Yields each output manifest entry as soon as its node has executed,
+    # rather than once the whole workflow has finished. Anything missed, such
+    # as while the websocket was reconnecting, is yielded from the history.
+    # If the prompt times out or the generator is closed early, the prompt
+    # is cancelled on the server.
+    def stream_workflow(
+        self,
+        workflow,
+        optimize=False,
+        keep_previews=False,
+        keep_nodes=(),
+        trace=None,
+        timeout=PROMPT_TIMEOUT,
+    ):
         print("Running workflow")
         # self.reset_execution_cache()
 
-        prompt_id = self.queue_prompt(workflow)
-        self.wait_for_prompt_completion(workflow, prompt_id)
-        output_json = self.get_history(prompt_id)
-        print("outputs: ", output_json)
+        if optimize:
+            workflow = self.optimize_workflow(workflow, keep_previews, keep_nodes)
+
+        prompt_id = self.queue_prompt(workflow, trace)
+        if trace is not None:
+            trace.start_prompt(prompt_id, workflow)
+
+        seen = set()
+        messages = self.ws_session.subscribe()
+        self.ws_session.route(prompt_id, messages)
+        completed = False
+        try:
+            for message in self.prompt_messages(
+                workflow, {prompt_id}, messages, trace, timeout
+            ):
+                if message["type"] != "executed":
+                    continue
+                data = message["data"]
+                for output in self.output_manifest(
+                    {data["node"]: data.get("output") or {}}, prompt_id
+                ):
+                    seen.add(self.output_key(output))
+                    yield output
+            completed = True
+        except ComfyUIExecutionError as e:
+            completed = not isinstance(e, PromptTimeoutError)
+            raise
+        finally:
+            self.ws_session.unroute(prompt_id)
+            if not completed:
+                self.cancel_prompts([prompt_id], trace)
+
+        for output in self.output_manifest(
+            self.get_history(prompt_id, trace), prompt_id
+        ):
+            if self.output_key(output) not in seen:
+                yield output
+
+    def output_key(self, output):
+        return (output["type"], output["subfolder"], output["filename"])
+
+    def output_manifest(self, outputs, prompt_id=None):
+        return output_manifest(
+            outputs, self.output_directory, self.input_directory, prompt_id
+        )
+
+    def log_output_manifest(self, manifest):
+        log_output_manifest(manifest)
+
+    # Pipelined version of run_workflow for many similar prompts, such as
+    # animation frames. Prompts are queued ahead so the server always has the
+    # next one waiting, instead of idling while we fetch history and queue.
+    # Workflows are serialized as soon as they are queued, so the iterable can
+    # yield the same dict mutated between frames.
+    # on_complete(index, manifest) is called as soon as each workflow finishes.
+    # Returns the output manifest of each workflow, in the order they were given.
+    def run_workflows(
+        self,
+        workflows,
+        max_in_flight=None,
+        on_complete=None,
+        optimize=False,
+        keep_previews=False,
+        keep_nodes=(),
+        trace=None,
+        timeout=PROMPT_TIMEOUT,
+    ):
+        outputs = {}
+        for index, manifest in self.stream_workflows(
+            workflows,
+            max_in_flight,
+            optimize,
+            keep_previews,
+            keep_nodes,
+            trace,
+            timeout,
+        ):
+            outputs[index] = manifest
+            if on_complete:
+                on_complete(index, manifest)
+        return [outputs[index] for index in range(len(outputs))]
+
+    # Generator version of run_workflows, yields (index, manifest) as soon as
+    # each workflow finishes. Stopping early stops queueing new workflows.
+    # Each prompt has timeout seconds once it starts executing. If one fails
+    # or times out, or the generator is closed early, the prompts still queued
+    # are deleted and the running one is interrupted. A failed prompt has
+    # already stopped, so it is not cancelled itself.
+    def stream_workflows(
+        self,
+        workflows,
+        max_in_flight=None,
+        optimize=False,
+        keep_previews=False,
+        keep_nodes=(),
+        trace=None,
+        timeout=PROMPT_TIMEOUT,
+    ):
+        print("Running workflows")
+        workflows = iter(workflows)
+        pending = {}
+        queued = 0
+        exhausted = False
+        workflow = None
+        messages = self.ws_session.subscribe()
+
+        try:
+            while True:
+                while not exhausted and (
+                    max_in_flight is None or len(pending) < max_in_flight
+                ):
+                    try:
+                        workflow = next(workflows)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if optimize:
+                        workflow = self.optimize_workflow(
+                            workflow, keep_previews, keep_nodes
+                        )
+                    prompt_id = self.queue_prompt(workflow, trace)
+                    if trace is not None:
+                        trace.start_prompt(prompt_id, workflow)
+                    self.ws_session.route(prompt_id, messages)
+                    pending[prompt_id] = queued
+                    queued += 1
+
+                if not pending:
+                    break
+
+                try:
+                    prompt_id = self.wait_for_any_prompt_completion(
+                        workflow, pending, messages, trace=trace, timeout=timeout
+                    )
+                except ComfyUIExecutionError as e:
+                    if not isinstance(e, PromptTimeoutError):
+                        self.ws_session.unroute(e.prompt_id)
+                        pending.pop(e.prompt_id, None)
+                    raise
+                self.ws_session.unroute(prompt_id)
+                index = pending.pop(prompt_id)
+                manifest = self.output_manifest(
+                    self.get_history(prompt_id, trace), prompt_id
+                )
+                print(f"Workflow {index + 1} finished, {len(pending)} still queued")
+                yield index, manifest
+        finally:
+            for prompt_id in pending:
+                self.ws_session.unroute(prompt_id)
+            self.cancel_prompts(pending, trace)
+
         print("====================================")
 
-    def get_history(self, prompt_id):
-        with urllib.request.urlopen(
-            f"http://{self.server_address}/history/{prompt_id}"
-        ) as response:
-            output = json.loads(response.read())
-            return output[prompt_id]["outputs"]
+    def get_history(self, prompt_id, trace=None):
+        output = self.http.get_json(
+            f"/history/{prompt_id}", name="get_history", stats=http_stats(trace)
+        )
+        return output[prompt_id]["outputs"]
@@ -0,0 +1,284 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+import aiohttp
+
+from helpers.comfyui import (
+    FAILURE_MESSAGE_TYPES,
+    PROMPT_TIMEOUT,
+    ComfyUIExecutionError,
+    PromptTimeoutError,
+    history_failure,
+    output_manifest,
+    log_output_manifest,
+)
+from helpers.http_client import HTTPError
+from helpers.websocket_session import MAX_UNCLAIMED_PROMPTS
+
+
+# asyncio counterpart to ComfyUI, for driving many prompts, downloads and
+# encoders from one event loop without threads. It talks to an already
+# running server; starting the server and fetching weights stay in ComfyUI.
+#
+# A single reader task receives every websocket message and resolves the
+# future of the prompt it belongs to, so any number of prompts can be
+# awaited at once:
+#
+#     async with AsyncComfyUI("127.0.0.1:8188", INPUT_DIR, OUTPUT_DIR) as client:
+#         outputs = await asyncio.gather(*(client.run_workflow(wf) for wf in workflows))
+class AsyncComfyUI:
+    def __init__(
+        self,
+        server_address,
+        input_directory,
+        output_directory,
+        reconnect_delay=0.5,
+        max_reconnect_delay=10,
+    ):
+        self.server_address = server_address
+        self.input_directory = input_directory
+        self.output_directory = output_directory
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.client_id = str(uuid.uuid4())
+        self.session = None
+        self.ws = None
+        self.reader = None
+        self.closed = False
+        self.futures = {}
+        self.listeners = {}
+        self.unclaimed = OrderedDict()
+        self.downloads = {}
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(f"http://{self.server_address}")
+        await self._connect()
+        self.reader = asyncio.create_task(self._read_messages())
+        return self
+
+    async def close(self):
+        self.closed = True
+        if self.reader:
+            self.reader.cancel()
+            try:
+                await self.reader
+            except asyncio.CancelledError:
+                pass
+        if self.ws:
+            await self.ws.close()
+        if self.session:
+            await self.session.close()
+        for future in self.futures.values():
+            if not future.done():
+                future.cancel()
+
+    async def _connect(self):
+        self.ws = await self.session.ws_connect(
+            f"/ws?clientId={self.client_id}", heartbeat=10
+        )
+
+    async def _reconnect(self):
+        delay = self.reconnect_delay
+        while not self.closed:
+            try:
+                await self._connect()
+                break
+            except (OSError, aiohttp.ClientError) as e:
+                print(f"Websocket reconnect failed: {e}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+        if self.closed:
+            return
+
+        print("Websocket reconnected")
+        # Messages sent while we were disconnected are lost, so check the
+        # history of every prompt that is still being waited on
+        for prompt_id in [p for p, f in self.futures.items() if not f.done()]:
+            try:
+                history = await self._get_json(f"/history/{prompt_id}")
+            except (OSError, aiohttp.ClientError, HTTPError) as e:
+                print(f"Could not check prompt {prompt_id} after reconnecting: {e}")
+                continue
+            if prompt_id in history:
+                self.dispatch(
+                    history_failure(history[prompt_id])
+                    or {
+                        "type": "executing",
+                        "data": {"node": None, "prompt_id": prompt_id},
+                    }
+                )
+
+    async def _read_messages(self):
+        while not self.closed:
+            message = await self.ws.receive()
+            if message.type == aiohttp.WSMsgType.TEXT:
+                self.dispatch(json.loads(message.data))
+            elif message.type in (
+                aiohttp.WSMsgType.CLOSE,
+                aiohttp.WSMsgType.CLOSING,
+                aiohttp.WSMsgType.CLOSED,
+                aiohttp.WSMsgType.ERROR,
+            ):
+                if not self.closed:
+                    await self._reconnect()
+
+    def dispatch(self, message):
+        data = message.get("data")
+        prompt_id = data.get("prompt_id") if isinstance(data, dict) else None
+        if prompt_id is None:
+            return
+
+        message.setdefault("received_at", time.perf_counter())
+        if prompt_id not in self.futures:
+            self.unclaimed.setdefault(prompt_id, []).append(message)
+            self.unclaimed.move_to_end(prompt_id)
+            while len(self.unclaimed) > MAX_UNCLAIMED_PROMPTS:
+                self.unclaimed.popitem(last=False)
+            return
+
+        listener = self.listeners.get(prompt_id)
+        if listener is not None:
+            listener(message)
+
+        future = self.futures[prompt_id]
+        if message["type"] in FAILURE_MESSAGE_TYPES and not future.done():
+            future.set_exception(ComfyUIExecutionError.from_message(message))
+        elif (
+            message["type"] == "executing"
+            and data.get("node") is None
+            and not future.done()
+        ):
+            future.set_result(prompt_id)
+
+    async def _request(self, method, path, payload=None):
+        async with self.session.request(method, path, json=payload) as response:
+            data = await response.read()
+            if response.status >= 400:
+                raise HTTPError(method, path, response.status, data)
+            return data
+
+    async def _get_json(self, path):
+        return json.loads(await self._request("GET", path))
+
+    async def queue_prompt(self, prompt):
+        p = {"prompt": prompt, "client_id": self.client_id}
+        output = json.loads(await self._request("POST", "/prompt", p))
+        return output["prompt_id"]
+
+    # Waits for the prompt to finish. on_message(message) is called with every
+    # message for the prompt, including any that arrived before waiting.
+    # Raises ComfyUIExecutionError if the prompt fails. If it times out or the
+    # waiting task is cancelled, the prompt is cancelled on the server too.
+    # A timeout of 0 waits forever, as with COMFYUI_PROMPT_TIMEOUT.
+    async def wait_for_prompt(self, prompt_id, on_message=None, timeout=PROMPT_TIMEOUT):
+        future = self.futures.get(prompt_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.futures[prompt_id] = future
+        if on_message is not None:
+            self.listeners[prompt_id] = on_message
+        for message in self.unclaimed.pop(prompt_id, []):
+            self.dispatch(message)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout or None)
+        except asyncio.TimeoutError:
+            await self.cancel_prompts([prompt_id])
+            raise PromptTimeoutError(prompt_id, timeout)
+        except asyncio.CancelledError:
+            await asyncio.shield(self.cancel_prompts([prompt_id]))
+            raise
+        finally:
+            self.futures.pop(prompt_id, None)
+            self.listeners.pop(prompt_id, None)
+
+    # Async version of ComfyUI.cancel_prompts
+    async def cancel_prompts(self, prompt_ids):
+        prompt_ids = set(prompt_ids)
+        try:
+            server_queue = await self._get_json("/queue")
+            running = {item[1] for item in server_queue.get("queue_running", [])}
+            if prompt_ids - running:
+                await self._request(
+                    "POST", "/queue", {"delete": sorted(prompt_ids - running)}
+                )
+            for prompt_id in prompt_ids & running:
+                await self._request("POST", "/interrupt", {"prompt_id": prompt_id})
+        except (OSError, aiohttp.ClientError, HTTPError, ValueError) as e:
+            print(f"Could not cancel prompts {sorted(prompt_ids)}: {e}")
+
+    async def get_history(self, prompt_id):
+        output = await self._get_json(f"/history/{prompt_id}")
+        return output[prompt_id]["outputs"]
+
+    async def run_workflow(self, workflow, on_message=None, timeout=PROMPT_TIMEOUT):
+        prompt_id = await self.queue_prompt(workflow)
+        await self.wait_for_prompt(prompt_id, on_message=on_message, timeout=timeout)
+        manifest = output_manifest(
+            await self.get_history(prompt_id),
+            self.output_directory,
+            self.input_directory,
+            prompt_id,
+        )
+        log_output_manifest(manifest)
+        return manifest
+
+    # Downloads a URL into the input directory, unless it is already there.
+    # Concurrent requests for the same URL share one download.
+    async def download_input(self, url, filename=None):
+        path = os.path.join(self.input_directory, filename or os.path.basename(url))
+        if os.path.exists(path):
+            return path
+
+        if path not in self.downloads:
+            self.downloads[path] = asyncio.ensure_future(self._download(url, path))
+        try:
+            return await asyncio.shield(self.downloads[path])
+        finally:
+            if self.downloads.get(path) is not None and self.downloads[path].done():
+                self.downloads.pop(path, None)
+
+    async def _download(self, url, path):
+        print(f"Downloading {url} to {path}")
+        start = time.time()
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(url) as response:
+                    response.raise_for_status()
+                    with open(tmp_path, "wb") as f:
+                        async for chunk in response.content.iter_chunked(1024 * 1024):
+                            f.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        print(f"✅ {path} downloaded in {time.time() - start:.2f}s")
+        return path
+
+    # Async version of ComfyUI.handle_inputs, URLs are downloaded concurrently
+    async def handle_inputs(self, workflow):
+        urls = {}
+        for node in workflow.values():
+            for input_key, input_value in node.get("inputs", {}).items():
+                if isinstance(input_value, str) and input_value.startswith(
+                    ("http://", "https://")
+                ):
+                    urls.setdefault(input_value, []).append((node, input_key))
+
+        paths = await asyncio.gather(*(self.download_input(url) for url in urls))
+        for (url, targets), path in zip(urls.items(), paths):
+            for node, input_key in targets:
+                node["inputs"][input_key] = path
+        return workflow
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+# A flat directory of files kept within a size budget.
+# Files are written atomically and evicted least recently used first. Use is
+# tracked with the file mtime, so the order survives restarts.
+class DiskCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.pins = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        path = self.path(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    # Hardlinks the file into the cache when possible, copies it otherwise
+    def put_file(self, name, source, link=True):
+        path = self.get(name)
+        if path:
+            return path
+
+        path = self.path(name)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            if link:
+                try:
+                    os.link(source, tmp_path)
+                except OSError:
+                    shutil.copyfile(source, tmp_path)
+            else:
+                shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        os.utime(path)
+        return path
+
+    def put_bytes(self, name, data):
+        path = self.get(name)
+        if path:
+            return path
+
+        path = self.path(name)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return path
+
+    # Pinned files are never evicted. Each owner, such as a running
+    # prediction, pins the files it needs and unpins them all when done.
+    def pin(self, owner, names):
+        with self.lock:
+            self.pins.setdefault(owner, set()).update(name for name in names if name)
+
+    def unpin(self, owner):
+        with self.lock:
+            self.pins.pop(owner, None)
+
+    def size(self):
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def _entries(self):
+        with os.scandir(self.directory) as entries:
+            return [
+                entry
+                for entry in entries
+                if entry.is_file() and not entry.name.endswith(".tmp")
+            ]
+
+    # Removes the least recently used files until the cache fits its budget,
+    # files named in keep or pinned are never removed
+    def evict(self, keep=()):
+        keep = set(keep)
+        with self.lock:
+            for names in self.pins.values():
+                keep.update(names)
+            entries = [(entry, entry.stat()) for entry in self._entries()]
+            total = sum(stat.st_size for _, stat in entries)
+            if total <= self.max_bytes:
+                return 0
+
+            removed = 0
+            for entry, stat in sorted(entries, key=lambda e: e[1].st_mtime):
+                if total <= self.max_bytes:
+                    break
+                if entry.name in keep:
+                    continue
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+                total -= stat.st_size
+                removed += 1
+
+            print(f"Evicted {removed} files from {self.directory}")
+            return removed
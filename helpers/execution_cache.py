@@ -0,0 +1,219 @@
+import os
+import shutil
+import threading
+
+from helpers.http_client import HTTPError
+
+# How many prompts' results ComfyUI keeps, instead of only the last one.
+# Uses --cache-lru where ComfyUI has it, and the sidecar extension in
+# helpers/execution_cache_extension otherwise. 0 keeps ComfyUI's default cache.
+CACHE_LRU_SIZE = int(os.environ.get("COMFYUI_CACHE_LRU", 8))
+
+# Below this fraction of free VRAM the server cache is flushed
+MIN_FREE_VRAM = float(os.environ.get("COMFYUI_CACHE_MIN_FREE_VRAM", 0.1))
+
+CLI_ARGS_PATH = "ComfyUI/comfy/cli_args.py"
+EXTENSION_SOURCE = "helpers/execution_cache_extension"
+EXTENSION_PATH = "ComfyUI/custom_nodes/cog_execution_cache"
+
+
+# Execution cache hits and misses by node class type, counted from
+# execution_cached and executing messages
+class CacheStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def record(self, message, workflow):
+        data = message.get("data", {})
+        with self.lock:
+            if message["type"] == "execution_cached":
+                for node_id in data.get("nodes", []):
+                    class_type = workflow.get(node_id, {}).get("class_type", "Unknown")
+                    self.stats["hits"] += 1
+                    stat = self.stats["by_class_type"].setdefault(
+                        class_type, {"hits": 0, "misses": 0}
+                    )
+                    stat["hits"] += 1
+            elif message["type"] == "executing" and data.get("node") is not None:
+                class_type = workflow.get(data["node"], {}).get("class_type", "Unknown")
+                self.stats["misses"] += 1
+                stat = self.stats["by_class_type"].setdefault(
+                    class_type, {"hits": 0, "misses": 0}
+                )
+                stat["misses"] += 1
+
+    def reset(self):
+        with self.lock:
+            self.stats = {"hits": 0, "misses": 0, "by_class_type": {}}
+
+    def hit_rate(self):
+        with self.lock:
+            total = self.stats["hits"] + self.stats["misses"]
+            return self.stats["hits"] / total if total else 0.0
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "hits": self.stats["hits"],
+                "misses": self.stats["misses"],
+                "by_class_type": {
+                    class_type: dict(stat)
+                    for class_type, stat in self.stats["by_class_type"].items()
+                },
+            }
+
+    def log(self):
+        stats = self.snapshot()
+        total = stats["hits"] + stats["misses"]
+        if not total:
+            return
+        print(
+            f"Execution cache: {stats['hits']} of {total} nodes cached ({stats['hits'] / total:.0%})"
+        )
+        for class_type, stat in sorted(
+            stats["by_class_type"].items(), key=lambda item: -item[1]["hits"]
+        ):
+            if stat["hits"]:
+                print(
+                    f"  {class_type}: {stat['hits']} cached, {stat['misses']} executed"
+                )
+
+
+# Manages ComfyUI's execution cache from the outside:
+# - keeps the results of several prompts, with --cache-lru or the extension
+# - invalidates the cached results of particular node types or models, by
+#   adding a _cache_nonce input that changes the node's cache signature
+#   (ComfyUI ignores inputs a node does not declare when running it)
+# - flushes the cache when free VRAM drops below a watermark
+# - counts cache hits from execution_cached messages
+class ExecutionCache:
+    def __init__(self, http, lru_size=CACHE_LRU_SIZE, min_free_vram=MIN_FREE_VRAM):
+        self.http = http
+        self.lru_size = lru_size
+        self.min_free_vram = min_free_vram
+        self.nonces = {}
+        self.uses_extension = False
+        self.lock = threading.Lock()
+        self.stats = CacheStats()
+
+    def supports_lru(self):
+        try:
+            with open(CLI_ARGS_PATH, "r") as f:
+                return "--cache-lru" in f.read()
+        except OSError:
+            return False
+
+    # Also installs or removes the extension, so call it before launching
+    def launch_args(self):
+        self.uses_extension = bool(self.lru_size) and not self.supports_lru()
+        if self.uses_extension:
+            shutil.copytree(EXTENSION_SOURCE, EXTENSION_PATH, dirs_exist_ok=True)
+        else:
+            shutil.rmtree(EXTENSION_PATH, ignore_errors=True)
+
+        if not self.lru_size:
+            return []
+        if self.uses_extension:
+            print(
+                f"Caching the results of the last {self.lru_size} prompts with the execution cache extension"
+            )
+            return []
+        print(f"Caching the results of the last {self.lru_size} prompts")
+        return ["--cache-lru", str(self.lru_size)]
+
+    # Cached results of these node types, or of nodes that load these
+    # weights, are not used by any later prompt
+    def invalidate(self, class_types=(), weights=()):
+        with self.lock:
+            for key in [("class_type", c) for c in class_types] + [
+                ("weights", w) for w in weights
+            ]:
+                self.nonces[key] = self.nonces.get(key, 0) + 1
+        print(f"Invalidated cached results for {list(class_types) + list(weights)}")
+
+    def _nonce(self, node):
+        inputs = node.get("inputs", {})
+        keys = [("class_type", node.get("class_type"))] + [
+            ("weights", value) for value in inputs.values() if isinstance(value, str)
+        ]
+        nonces = [f"{key[1]}:{self.nonces[key]}" for key in keys if key in self.nonces]
+        return "|".join(nonces) if nonces else None
+
+    # Returns the prompt with nonces added to invalidated nodes, only the
+    # nodes that change are copied
+    def apply_nonces(self, prompt):
+        with self.lock:
+            if not self.nonces:
+                return prompt
+            changed = {}
+            for node_id, node in prompt.items():
+                nonce = self._nonce(node)
+                if nonce is not None:
+                    changed[node_id] = {
+                        **node,
+                        "inputs": {**node.get("inputs", {}), "_cache_nonce": nonce},
+                    }
+        return {**prompt, **changed} if changed else prompt
+
+    # Counts are kept for the whole process, and in stats if given, such as
+    # the CacheStats of one prediction
+    def record(self, message, workflow, stats=None):
+        self.stats.record(message, workflow)
+        if stats is not None:
+            stats.record(message, workflow)
+
+    def reset_stats(self):
+        self.stats.reset()
+
+    def hit_rate(self):
+        return self.stats.hit_rate()
+
+    def log_stats(self):
+        self.stats.log()
+
+    def free_vram_fraction(self):
+        try:
+            stats = self.http.get_json("/system_stats", name="system_stats")
+        except (OSError, HTTPError, ValueError) as e:
+            print(f"Could not read system stats: {e}")
+            return None
+        devices = [d for d in stats.get("devices", []) if d.get("vram_total")]
+        if not devices:
+            return None
+        return min(d["vram_free"] / d["vram_total"] for d in devices)
+
+    # Flushes the server's cache if free VRAM is below the watermark. This
+    # runs after a prediction has returned its outputs, so errors are only
+    # logged.
+    def enforce_watermark(self, reset):
+        try:
+            free = self.free_vram_fraction()
+            if free is None or free >= self.min_free_vram:
+                return False
+            print(f"Only {free:.0%} of VRAM is free, flushing the execution cache")
+            self.flush(reset)
+        except Exception as e:
+            print(f"Could not flush the execution cache: {e}")
+            return False
+        return True
+
+    # Uses /free on servers that have it, otherwise calls reset, which should
+    # queue a workflow that replaces everything cached
+    def flush(self, reset):
+        if self.uses_extension:
+            try:
+                self.http.post_json(
+                    "/execution_cache/clear", {}, name="clear_execution_cache"
+                )
+            except (OSError, HTTPError, ValueError) as e:
+                print(f"Could not clear the execution cache extension: {e}")
+        try:
+            self.http.post_json(
+                "/free", {"unload_models": False, "free_memory": True}, name="free"
+            )
+        except HTTPError as e:
+            # Servers without /free answer 405 from their static routes
+            if e.status not in (404, 405):
+                raise
+            reset()
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import threading
+
+import execution
+from aiohttp import web
+from server import PromptServer
+
+# Sidecar for ComfyUIs without --cache-lru, installed into custom_nodes by
+# helpers/execution_cache.py. ComfyUI keeps one result per node id, from the
+# last prompt that ran it. This keeps the results of the last CACHE_LRU_SIZE
+# prompts, by node id and signature, and puts them back in the executor
+# before each prompt runs, so ComfyUI reuses them and reports them as cached.
+
+CACHE_LRU_SIZE = int(os.environ.get("COMFYUI_CACHE_LRU", 8))
+
+# Nothing to add to the node list, ComfyUI still imports the module
+NODE_CLASS_MAPPINGS = {}
+
+
+def is_link(value):
+    return (
+        isinstance(value, list)
+        and len(value) == 2
+        and isinstance(value[0], str)
+        and isinstance(value[1], int)
+    )
+
+
+# A node's signature covers its class, its inputs and, through the
+# signatures of the nodes it takes inputs from, everything upstream of it
+def signatures(prompt):
+    result = {}
+
+    def signature(node_id):
+        if node_id in result:
+            return result[node_id]
+        result[node_id] = None
+        node = prompt[node_id]
+        inputs = {}
+        for key, value in node.get("inputs", {}).items():
+            if is_link(value):
+                upstream = signature(value[0]) if value[0] in prompt else None
+                inputs[key] = [upstream, value[1]]
+            else:
+                inputs[key] = value
+        key = json.dumps([node.get("class_type"), inputs], sort_keys=True, default=str)
+        result[node_id] = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return result[node_id]
+
+    for node_id in prompt:
+        signature(node_id)
+    return result
+
+
+# Results by (node id, signature). Each entry remembers the last prompt that
+# used it, entries not used by any of the last size prompts are dropped.
+class ResultLRU:
+    def __init__(self, size):
+        self.size = size
+        self.entries = {}
+        self.prompts = 0
+        self.lock = threading.Lock()
+
+    def restore(self, executor, prompt_signatures):
+        with self.lock:
+            self.prompts += 1
+            restored = 0
+            for node_id, signature in prompt_signatures.items():
+                entry = self.entries.get((node_id, signature))
+                if entry is None:
+                    continue
+                entry["used"] = self.prompts
+                executor.outputs[node_id] = entry["outputs"]
+                executor.old_prompt[node_id] = entry["old_prompt"]
+                if entry["outputs_ui"] is not None:
+                    executor.outputs_ui[node_id] = entry["outputs_ui"]
+                restored += 1
+            return restored
+
+    # Only results the executor holds for this prompt's version of a node
+    # are kept, not leftovers from an earlier prompt
+    def save(self, executor, prompt, prompt_signatures):
+        with self.lock:
+            for node_id, signature in prompt_signatures.items():
+                old = executor.old_prompt.get(node_id)
+                if node_id not in executor.outputs or old is None:
+                    continue
+                if old.get("inputs") != prompt[node_id].get("inputs"):
+                    continue
+                self.entries[(node_id, signature)] = {
+                    "outputs": executor.outputs[node_id],
+                    "old_prompt": old,
+                    "outputs_ui": executor.outputs_ui.get(node_id),
+                    "used": self.prompts,
+                }
+            for key in [
+                key
+                for key, entry in self.entries.items()
+                if entry["used"] <= self.prompts - self.size
+            ]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            cleared = len(self.entries)
+            self.entries = {}
+            return cleared
+
+
+# The executor internals this relies on were replaced along with the
+# execution model that added --cache-lru
+if CACHE_LRU_SIZE and hasattr(execution, "recursive_output_delete_if_changed"):
+    cache = ResultLRU(CACHE_LRU_SIZE)
+    original_execute = execution.PromptExecutor.execute
+
+    def execute(self, prompt, prompt_id, extra_data={}, execute_outputs=[]):
+        prompt_signatures = signatures(prompt)
+        cache.restore(self, prompt_signatures)
+        try:
+            return original_execute(
+                self, prompt, prompt_id, extra_data, execute_outputs
+            )
+        finally:
+            cache.save(self, prompt, prompt_signatures)
+
+    execution.PromptExecutor.execute = execute
+
+    @PromptServer.instance.routes.post("/execution_cache/clear")
+    async def clear_execution_cache(request):
+        return web.json_response({"cleared": cache.clear()})
+
+    print(f"Execution cache keeps the results of the last {CACHE_LRU_SIZE} prompts")
+else:
+    print("Execution cache extension is not supported by this ComfyUI, not loaded")
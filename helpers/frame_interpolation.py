@@ -0,0 +1,63 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+
+def keyframe_numbers(frame_count, interval):
+    keyframes = list(range(0, frame_count, interval))
+    # Always diffuse the last frame so the animation ends where exact mode does
+    if keyframes[-1] != frame_count - 1:
+        keyframes.append(frame_count - 1)
+    return keyframes
+
+
+def load_frame(path):
+    with Image.open(path) as image:
+        return np.asarray(image.convert("RGB"), dtype=np.float32)
+
+
+def crossfade(frame_a, frame_b, t):
+    blended = frame_a * (1 - t) + frame_b * t
+    image = Image.fromarray(np.clip(blended + 0.5, 0, 255).astype(np.uint8))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+# Sends diffused keyframes to a FrameEncoder and fills the frames between
+# each pair of neighbouring keyframes with crossfades as soon as both of
+# them have been generated. Keyframes can arrive in any order.
+class KeyframeInterpolator:
+    def __init__(self, encoder, keyframes):
+        self.encoder = encoder
+        self.keyframes = keyframes
+        self.positions = {frame_number: i for i, frame_number in enumerate(keyframes)}
+        self.images = {}
+        self.interpolated_frames = 0
+
+    def add_keyframe(self, frame_number, image_path):
+        self.images[frame_number] = image_path
+        self.encoder.add_frame(frame_number, image_path)
+
+        position = self.positions[frame_number]
+        if position > 0:
+            self._fill(self.keyframes[position - 1], frame_number)
+        if position < len(self.keyframes) - 1:
+            self._fill(frame_number, self.keyframes[position + 1])
+
+    def _fill(self, start, end):
+        if start not in self.images or end not in self.images or end - start < 2:
+            return
+
+        frame_a = load_frame(self.images[start])
+        frame_b = load_frame(self.images[end])
+        if frame_a.shape != frame_b.shape:
+            raise ValueError(
+                f"Cannot interpolate between keyframes of different sizes: {frame_a.shape} and {frame_b.shape}"
+            )
+
+        for frame_number in range(start + 1, end):
+            t = (frame_number - start) / (end - start)
+            self.encoder.add_frame(frame_number, crossfade(frame_a, frame_b, t))
+            self.interpolated_frames += 1
@@ -0,0 +1,145 @@
+import http.client
+import json
+import queue
+import threading
+import time
+
+
+class HTTPError(Exception):
+    def __init__(self, method, path, status, body):
+        self.method = method
+        self.path = path
+        self.status = status
+        self.body = body
+        super().__init__(f"{method} {path} returned {status}: {body[:500]!r}")
+
+
+# Latency of HTTP calls by name. The client keeps one for the whole process,
+# and each prediction can pass its own to request, so concurrent predictions
+# see only their own calls.
+class LatencyStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def record(self, name, elapsed):
+        with self.lock:
+            stat = self.latency.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+            stat["count"] += 1
+            stat["total"] += elapsed
+            stat["max"] = max(stat["max"], elapsed)
+
+    def stats(self):
+        with self.lock:
+            return {name: dict(stat) for name, stat in self.latency.items()}
+
+    def reset(self):
+        with self.lock:
+            self.latency = {}
+
+    def log(self):
+        stats = self.stats()
+        total = sum(stat["total"] for stat in stats.values())
+        calls = sum(stat["count"] for stat in stats.values())
+        print(f"ComfyUI API: {calls} calls, {total * 1000:.1f}ms total")
+        for name, stat in sorted(stats.items()):
+            print(
+                f"  {name}: {stat['count']} calls, {stat['total'] * 1000:.1f}ms total, "
+                f"{stat['total'] * 1000 / stat['count']:.1f}ms avg, {stat['max'] * 1000:.1f}ms max"
+            )
+
+
+# Keep-alive HTTP client for the local ComfyUI server.
+# Connections are pooled and reused between calls, and the latency of every
+# call is recorded by name so control-plane overhead can be measured.
+class HTTPClient:
+    RETRYABLE_ERRORS = (
+        http.client.RemoteDisconnected,
+        http.client.CannotSendRequest,
+        ConnectionResetError,
+        BrokenPipeError,
+    )
+
+    def __init__(self, server_address, pool_size=4, timeout=None):
+        self.server_address = server_address
+        self.timeout = timeout
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+        self.latency_stats = LatencyStats()
+
+    def _get_connection(self):
+        try:
+            return self.pool.get_nowait(), True
+        except queue.Empty:
+            return (
+                http.client.HTTPConnection(self.server_address, timeout=self.timeout),
+                False,
+            )
+
+    def _release_connection(self, connection):
+        try:
+            self.pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def request(self, method, path, body=None, name=None, stats=None):
+        start = time.perf_counter()
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        try:
+            while True:
+                connection, reused = self._get_connection()
+                try:
+                    connection.request(method, path, body=body, headers=headers)
+                    response = connection.getresponse()
+                    data = response.read()
+                    break
+                except self.RETRYABLE_ERRORS:
+                    connection.close()
+                    # The server closed an idle pooled connection, try a fresh one
+                    if not reused:
+                        raise
+                except Exception:
+                    connection.close()
+                    raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._release_connection(connection)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.latency_stats.record(name or f"{method} {path}", elapsed)
+            if stats is not None:
+                stats.record(name or f"{method} {path}", elapsed)
+
+        if response.status >= 400:
+            raise HTTPError(method, path, response.status, data)
+        return data
+
+    def get_json(self, path, name=None, stats=None):
+        return json.loads(self.request("GET", path, name=name, stats=stats))
+
+    def post_json(self, path, payload, name=None, stats=None):
+        data = self.request(
+            "POST",
+            path,
+            body=json.dumps(payload).encode("utf-8"),
+            name=name,
+            stats=stats,
+        )
+        return json.loads(data) if data else None
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def stats(self):
+        return self.latency_stats.stats()
+
+    def reset_stats(self):
+        self.latency_stats.reset()
+
+    def log_stats(self):
+        self.latency_stats.log()
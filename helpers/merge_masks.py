@@ -0,0 +1,37 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+
+# Builds the attention masks used to merge two images, for any number of
+# offsets at once. This is the same mask the SolidMask -> FeatherMask ->
+# MaskComposite (add) -> InvertMask chain builds inside ComfyUI:
+# zero up to the offset, then a feathered ramp up to 1 over `split` pixels.
+def merge_mask_profiles(length, split, offsets):
+    source = np.ones(length, dtype=np.float32)
+    split = min(split, length)
+    if split > 0:
+        source[:split] = (np.arange(split, dtype=np.float32) + 1) / split
+
+    positions = np.arange(length)[None, :] - np.asarray(offsets)[:, None]
+    return np.where(positions >= 0, source[np.clip(positions, 0, length - 1)], 0)
+
+
+# Returns masks shaped (len(offsets), height, width) with values from 0 to 1
+def merge_masks(merge_mode, width, height, offsets):
+    if merge_mode == "left_right":
+        profiles = merge_mask_profiles(width, width // 2, offsets)
+        return np.broadcast_to(profiles[:, None, :], (len(offsets), height, width))
+    elif merge_mode == "top_bottom":
+        profiles = merge_mask_profiles(height, height // 2, offsets)
+        return np.broadcast_to(profiles[:, :, None], (len(offsets), height, width))
+    raise ValueError(f"No merge mask for merge mode {merge_mode}")
+
+
+# Grayscale PNG, which LoadImageMask reads through its red channel
+def mask_to_png(mask):
+    image = Image.fromarray(np.round(mask * 255).astype(np.uint8), mode="L")
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
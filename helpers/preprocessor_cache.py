@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from helpers.disk_cache import DiskCache, file_sha256
+
+# Hashes of input images are remembered for this many of the most recently
+# used files, so the memo does not grow with every input ever seen
+MAX_IMAGE_HASHES = 1024
+
+
+# Caches the output of controlnet preprocessor nodes on disk, keyed by the
+# content of their input image, the preprocessor and its settings.
+#
+# On a hit the preprocessor node is replaced by a LoadImage of the cached
+# map. On a miss the map is saved from the PreviewImage node that shows it,
+# so a preprocessor can only be cached if its output is previewed.
+class PreprocessorCache:
+    def __init__(self, input_directory, max_bytes, subfolder="preprocessed"):
+        self.input_directory = input_directory
+        self.subfolder = subfolder
+        self.cache = DiskCache(os.path.join(input_directory, subfolder), max_bytes)
+        self.image_hashes = OrderedDict()
+        self.image_hashes_lock = threading.Lock()
+
+    def is_preprocessor(self, node):
+        class_type = node.get("class_type", "")
+        return class_type == "AIO_Preprocessor" or class_type.endswith("Preprocessor")
+
+    # Input files are replaced, never modified in place, so the inode
+    # identifies the content
+    def image_hash(self, filename):
+        path = os.path.join(self.input_directory, filename)
+        stat = os.stat(path)
+        memo_key = (filename, stat.st_ino, stat.st_size)
+        with self.image_hashes_lock:
+            image_hash = self.image_hashes.get(memo_key)
+            if image_hash is not None:
+                self.image_hashes.move_to_end(memo_key)
+                return image_hash
+
+        image_hash = file_sha256(path)
+        with self.image_hashes_lock:
+            self.image_hashes[memo_key] = image_hash
+            while len(self.image_hashes) > MAX_IMAGE_HASHES:
+                self.image_hashes.popitem(last=False)
+        return image_hash
+
+    def cache_key(self, workflow, node):
+        if not self.is_preprocessor(node):
+            return None
+
+        inputs = node.get("inputs", {})
+        image = inputs.get("image")
+        if not isinstance(image, list):
+            return None
+
+        source = workflow.get(image[0], {})
+        if source.get("class_type") != "LoadImage":
+            return None
+
+        try:
+            image_hash = self.image_hash(source["inputs"]["image"])
+        except (KeyError, OSError):
+            return None
+
+        settings = {k: v for k, v in inputs.items() if not isinstance(v, list)}
+        key = json.dumps([node["class_type"], image_hash, settings], sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+    # Finds the preprocessors in the workflow and whether their output is
+    # cached, as {node_id: cache key} for hits and misses
+    def lookup(self, workflow):
+        hits = {}
+        misses = {}
+        for node_id, node in workflow.items():
+            key = self.cache_key(workflow, node)
+            if key is None:
+                continue
+            if self.cache.get(f"{key}.png"):
+                hits[node_id] = key
+            else:
+                misses[node_id] = key
+        return hits, misses
+
+    def pin(self, owner, hits):
+        self.cache.pin(owner, [f"{key}.png" for key in hits.values()])
+
+    def unpin(self, owner):
+        self.cache.unpin(owner)
+
+    # Returns a copy of the workflow with each hit replaced by a LoadImage
+    def swap(self, workflow, hits):
+        if not hits:
+            return workflow
+
+        workflow = dict(workflow)
+        for node_id, key in hits.items():
+            workflow[node_id] = {
+                "inputs": {"image": f"{self.subfolder}/{key}.png", "upload": "image"},
+                "class_type": "LoadImage",
+                "_meta": {"title": f"Cached {workflow[node_id]['class_type']}"},
+            }
+        return workflow
+
+    # The PreviewImage nodes that show each missed preprocessor's output
+    def preview_nodes(self, workflow, misses):
+        previews = {}
+        for node_id, node in workflow.items():
+            if node.get("class_type") != "PreviewImage":
+                continue
+            images = node.get("inputs", {}).get("images")
+            if isinstance(images, list) and images[0] in misses:
+                previews[images[0]] = node_id
+        return previews
+
+    # Takes the output manifest of the run, see ComfyUI.output_manifest
+    def store(self, workflow, misses, outputs):
+        paths = {
+            output["node_id"]: output["path"]
+            for output in outputs
+            if output["frame_index"] == 0
+        }
+        stored = 0
+        for node_id, preview_id in self.preview_nodes(workflow, misses).items():
+            path = paths.get(preview_id)
+            if path and os.path.exists(path):
+                self.cache.put_file(f"{misses[node_id]}.png", path)
+                stored += 1
+
+        if stored:
+            self.cache.evict()
+        return stored
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import shutil
+
+from helpers.disk_cache import DiskCache
+
+
+# Caches the files a prediction returns, so an exact retry of a prediction
+# with a fixed seed is served from disk instead of being run again.
+#
+# The key is a hash of the rendered workflow and any options that change
+# what is returned. Inputs are staged under names derived from their
+# content, so the workflow already identifies the images it uses.
+#
+# An entry is its files plus a JSON index of them, written last, so an entry
+# is only found once all of its files are in the cache.
+class ResultCache:
+    def __init__(self, directory, max_bytes):
+        self.cache = DiskCache(directory, max_bytes)
+
+    # Titles and output filename prefixes do not change the result
+    def cache_key(self, workflow, options=None):
+        canonical = {
+            node_id: {
+                "class_type": node.get("class_type"),
+                "inputs": {
+                    k: v
+                    for k, v in node.get("inputs", {}).items()
+                    if k != "filename_prefix"
+                },
+            }
+            for node_id, node in workflow.items()
+        }
+        key = json.dumps(
+            [canonical, options or {}], sort_keys=True, separators=(",", ":")
+        )
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+    # Returns [(cached path, original filename)] in the order they were
+    # returned, or None on a miss. The files are pinned for owner.
+    def lookup(self, key, owner):
+        index_name = f"{key}.json"
+        self.cache.pin(owner, [index_name])
+        index_path = self.cache.get(index_name)
+        if index_path is None:
+            return None
+
+        try:
+            with open(index_path, "r") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        self.cache.pin(owner, [name for name, _ in entries])
+        results = []
+        for name, filename in entries:
+            path = self.cache.get(name)
+            if path is None:
+                # Evicted since the entry was written
+                return None
+            results.append((path, filename))
+        return results
+
+    def unpin(self, owner):
+        self.cache.unpin(owner)
+
+    # Links cached files into directory under their original names
+    def restore(self, results, directory):
+        paths = []
+        for i, (source, filename) in enumerate(results):
+            path = os.path.join(directory, filename)
+            if os.path.exists(path):
+                path = os.path.join(directory, f"{i}_{filename}")
+            try:
+                os.link(source, path)
+            except OSError:
+                shutil.copyfile(source, path)
+            paths.append(path)
+        return paths
+
+    # The prediction has already returned these files, so failing to cache
+    # them is only logged
+    def store(self, key, paths):
+        entries = []
+        index_name = f"{key}.json"
+        try:
+            for i, path in enumerate(paths):
+                name = f"{key}_{i}{os.path.splitext(path)[1]}"
+                self.cache.put_file(name, path)
+                entries.append([name, os.path.basename(path)])
+            self.cache.put_bytes(index_name, json.dumps(entries).encode("utf-8"))
+        except OSError as e:
+            print(f"Could not cache results as {key}: {e}")
+            return
+        self.cache.evict(keep=[name for name, _ in entries] + [index_name])
+        print(f"Cached {len(entries)} results as {key}")
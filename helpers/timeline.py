@@ -0,0 +1,36 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Records when each phase of a multi-step process starts and ends,
+# phases can overlap and be recorded from different threads
+class Timeline:
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.phases = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.phases.append((name, start - self.start, end - self.start))
+            print(f"⏱️  {name} took {end - start:.2f}s")
+
+    def run(self, name, fn, *args, **kwargs):
+        with self.phase(name):
+            return fn(*args, **kwargs)
+
+    def log(self):
+        total = time.perf_counter() - self.start
+        print(f"{self.name} timeline ({total:.2f}s total):")
+        with self.lock:
+            phases = sorted(self.phases, key=lambda phase: phase[1])
+        for name, start, end in phases:
+            print(f"  {start:7.2f}s → {end:7.2f}s  {name} ({end - start:.2f}s)")
@@ -0,0 +1,240 @@
+import json
+import threading
+import time
+
+from helpers.execution_cache import CacheStats
+from helpers.http_client import LatencyStats
+
+TRACE_FORMATS = ["json", "chrome"]
+
+
+# Execution trace of a single prompt, built from its websocket messages.
+# A node runs from its executing message until the next one, so the last
+# node ends with the executing message for node None.
+class PromptTrace:
+    def __init__(self, prompt_id, workflow, origin):
+        self.prompt_id = prompt_id
+        self.workflow = workflow
+        self.origin = origin
+        self.queued_at = time.perf_counter() - origin
+        self.start = None
+        self.end = None
+        self.current = None
+        self.nodes = {}
+        self.events = []
+
+    def node(self, node_id):
+        if node_id not in self.nodes:
+            node = self.workflow.get(node_id, {})
+            self.nodes[node_id] = {
+                "node_id": node_id,
+                "class_type": node.get("class_type", "Unknown"),
+                "title": node.get("_meta", {}).get("title", "Unknown"),
+                "start": None,
+                "end": None,
+                "duration": None,
+                "cached": False,
+                "progress": None,
+            }
+        return self.nodes[node_id]
+
+    def record(self, message):
+        at = message.get("received_at", time.perf_counter()) - self.origin
+        message_type = message["type"]
+        data = message.get("data", {})
+
+        if message_type == "execution_start":
+            self.start = at
+        elif message_type == "execution_cached":
+            for node_id in data.get("nodes", []):
+                self.node(node_id)["cached"] = True
+        elif message_type == "executing":
+            if self.start is None:
+                self.start = at
+            self._finish_current(at)
+            if data.get("node") is None:
+                self.end = at
+            else:
+                self.current = data["node"]
+                self.node(self.current)["start"] = at
+        elif message_type == "progress" and data.get("node") is not None:
+            self.node(data["node"])["progress"] = {
+                "value": data.get("value"),
+                "max": data.get("max"),
+            }
+        elif message_type != "executed":
+            return
+
+        event = {"type": message_type, "at": at}
+        if data.get("node") is not None:
+            event["node"] = data["node"]
+        if message_type == "execution_cached":
+            event["nodes"] = data.get("nodes", [])
+        if message_type == "progress":
+            event["value"] = data.get("value")
+            event["max"] = data.get("max")
+        self.events.append(event)
+
+    def _finish_current(self, at):
+        if self.current is None:
+            return
+        node = self.nodes[self.current]
+        node["end"] = at
+        node["duration"] = at - node["start"]
+        self.current = None
+
+    def to_dict(self):
+        return {
+            "prompt_id": self.prompt_id,
+            "queued_at": self.queued_at,
+            "start": self.start,
+            "end": self.end,
+            "duration": (
+                self.end - self.start
+                if self.start is not None and self.end is not None
+                else None
+            ),
+            "nodes": sorted(
+                self.nodes.values(),
+                key=lambda node: (node["start"] is None, node["start"] or 0),
+            ),
+            "events": self.events,
+        }
+
+
+# Collects the traces of every prompt in a prediction. Messages are
+# timestamped by the websocket reader as they arrive, see
+# WebSocketSession.dispatch, so a slow consumer does not skew timings.
+# The prediction's API call latencies and execution cache hits are counted
+# here too, apart from those of other predictions running at the same time.
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.origin = time.perf_counter()
+        self.prompts = {}
+        self.lock = threading.Lock()
+        self.http_stats = LatencyStats()
+        self.cache_stats = CacheStats()
+        # {"key", "hit", "files"} once the result cache has been looked up
+        self.result_cache = None
+
+    def start_prompt(self, prompt_id, workflow):
+        with self.lock:
+            self.prompts[prompt_id] = PromptTrace(prompt_id, workflow, self.origin)
+
+    def record(self, message):
+        data = message.get("data")
+        prompt_id = data.get("prompt_id") if isinstance(data, dict) else None
+        with self.lock:
+            prompt = self.prompts.get(prompt_id)
+            if prompt is not None:
+                prompt.record(message)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "name": self.name,
+                "prompts": [prompt.to_dict() for prompt in self.prompts.values()],
+                "http": self.http_stats.stats(),
+                "execution_cache": self.cache_stats.snapshot(),
+                "result_cache": self.result_cache,
+            }
+
+    # Chrome trace event format, open it in chrome://tracing or Perfetto.
+    # Each prompt is shown as its own thread.
+    def to_chrome_trace(self):
+        events = []
+        if self.result_cache is not None and self.result_cache["hit"]:
+            events.append(
+                {
+                    "name": "result cache hit",
+                    "ph": "i",
+                    "s": "g",
+                    "ts": 0,
+                    "pid": 1,
+                    "args": self.result_cache,
+                }
+            )
+        for tid, prompt in enumerate(self.to_dict()["prompts"], start=1):
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": tid,
+                    "args": {"name": f"prompt {prompt['prompt_id']}"},
+                }
+            )
+            for node in prompt["nodes"]:
+                args = {"node_id": node["node_id"], "class_type": node["class_type"]}
+                if node["cached"]:
+                    events.append(
+                        {
+                            "name": f"{node['title']} (cached)",
+                            "cat": node["class_type"],
+                            "ph": "i",
+                            "s": "t",
+                            "ts": (prompt["start"] or prompt["queued_at"]) * 1e6,
+                            "pid": 1,
+                            "tid": tid,
+                            "args": args,
+                        }
+                    )
+                if node["duration"] is not None:
+                    events.append(
+                        {
+                            "name": node["title"],
+                            "cat": node["class_type"],
+                            "ph": "X",
+                            "ts": node["start"] * 1e6,
+                            "dur": node["duration"] * 1e6,
+                            "pid": 1,
+                            "tid": tid,
+                            "args": args,
+                        }
+                    )
+            for event in prompt["events"]:
+                if event["type"] == "progress":
+                    events.append(
+                        {
+                            "name": f"progress {event['node']}",
+                            "ph": "C",
+                            "ts": event["at"] * 1e6,
+                            "pid": 1,
+                            "args": {"value": event["value"]},
+                        }
+                    )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path, trace_format="json"):
+        if trace_format not in TRACE_FORMATS:
+            raise ValueError(
+                f"Unknown trace format {trace_format}, expected one of {TRACE_FORMATS}"
+            )
+        trace = self.to_chrome_trace() if trace_format == "chrome" else self.to_dict()
+        with open(path, "w") as f:
+            json.dump(trace, f)
+        return path
+
+    # Wall time per node, summed over every prompt, slowest first
+    def log(self, limit=10):
+        totals = {}
+        for prompt in self.to_dict()["prompts"]:
+            for node in prompt["nodes"]:
+                total = totals.setdefault(
+                    node["node_id"],
+                    {"node": node, "duration": 0.0, "runs": 0, "cached": 0},
+                )
+                if node["cached"]:
+                    total["cached"] += 1
+                if node["duration"] is not None:
+                    total["duration"] += node["duration"]
+                    total["runs"] += 1
+
+        print(f"{self.name} trace, slowest nodes over {len(self.prompts)} prompts:")
+        for total in sorted(totals.values(), key=lambda t: -t["duration"])[:limit]:
+            node = total["node"]
+            print(
+                f"  {total['duration']:7.2f}s  node {node['node_id']}, {node['title']} ({node['class_type']}), "
+                f"ran {total['runs']}x, cached {total['cached']}x"
+            )
@@ -0,0 +1,81 @@
+import subprocess
+
+
+# Encodes frames with ffmpeg while they are still being generated.
+# Frames are piped in as PNG bytes and can be added in any order, they are
+# buffered until every earlier frame has been written.
+class FrameEncoder:
+    def __init__(self, output_path, fps=12):
+        self.output_path = output_path
+        self.fps = fps
+        self.process = None
+        self.pending = {}
+        self.next_index = 0
+        self.frames_written = 0
+
+    def start(self):
+        ffmpeg_command = [
+            "ffmpeg",
+            "-loglevel",
+            "error",
+            "-f",
+            "image2pipe",
+            "-framerate",
+            str(self.fps),
+            "-c:v",
+            "png",
+            "-i",
+            "-",  # Read frames from stdin
+            "-c:v",
+            "libx264",  # Video codec to be used
+            "-pix_fmt",
+            "yuv420p",  # Pixel format for compatibility
+            "-vf",
+            "format=yuv420p",  # Set the video format to yuv420p
+            "-y",  # Overwrite output file if it exists
+            self.output_path,
+        ]
+        self.process = subprocess.Popen(ffmpeg_command, stdin=subprocess.PIPE)
+        return self
+
+    # A frame is either a path to a PNG file or the PNG bytes themselves
+    def add_frame(self, index, frame):
+        self.pending[index] = frame
+        while self.next_index in self.pending:
+            self._write(self.pending.pop(self.next_index))
+            self.next_index += 1
+
+    def _write(self, frame):
+        if isinstance(frame, str):
+            with open(frame, "rb") as f:
+                frame = f.read()
+        try:
+            self.process.stdin.write(frame)
+            self.frames_written += 1
+        except BrokenPipeError:
+            # ffmpeg has exited, the error is raised from finish()
+            pass
+
+    def finish(self):
+        if self.pending:
+            print(
+                f"Warning: frames missing before {sorted(self.pending)}, encoding the remaining frames in order"
+            )
+            for index in sorted(self.pending):
+                self._write(self.pending.pop(index))
+
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        returncode = self.process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, "ffmpeg")
+
+        print(f"Encoded {self.frames_written} frames to {self.output_path}")
+        return self.output_path
+
+    def abort(self):
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
@@ -0,0 +1,144 @@
+import json
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import websocket
+
+# Messages for prompts nobody has claimed yet are kept for this many prompts,
+# this covers the gap between queueing a prompt and routing its id
+MAX_UNCLAIMED_PROMPTS = 64
+
+
+# One long-lived websocket to the ComfyUI server, shared by every prediction.
+# A reader thread receives all messages and routes them by prompt_id to the
+# queue of whoever is waiting on that prompt. The connection is pinged when
+# idle and reconnected with the same client_id if it drops.
+class WebSocketSession:
+    def __init__(
+        self,
+        server_address,
+        heartbeat_interval=10,
+        reconnect_delay=0.5,
+        max_reconnect_delay=10,
+        on_reconnect=None,
+    ):
+        self.server_address = server_address
+        self.client_id = str(uuid.uuid4())
+        self.heartbeat_interval = heartbeat_interval
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.on_reconnect = on_reconnect
+        self.ws = None
+        self.routes = {}
+        self.unclaimed = OrderedDict()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.reader = None
+
+    def start(self):
+        self._connect()
+        self.reader = threading.Thread(target=self._read_messages, daemon=True)
+        self.reader.start()
+        return self
+
+    def is_alive(self):
+        return not self.closed and self.reader is not None and self.reader.is_alive()
+
+    def close(self):
+        self.closed = True
+        if self.ws:
+            self.ws.close()
+
+    def _connect(self):
+        ws = websocket.WebSocket()
+        ws.connect(f"ws://{self.server_address}/ws?clientId={self.client_id}")
+        ws.settimeout(self.heartbeat_interval)
+        self.ws = ws
+
+    def _reconnect(self):
+        try:
+            self.ws.close()
+        except Exception:
+            pass
+
+        delay = self.reconnect_delay
+        while not self.closed:
+            try:
+                self._connect()
+                break
+            except (OSError, websocket.WebSocketException) as e:
+                print(f"Websocket reconnect failed: {e}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+        if self.closed:
+            return
+
+        print("Websocket reconnected")
+        # Messages sent while we were disconnected are lost, so let the owner
+        # check on the prompts that are still being waited on
+        with self.lock:
+            prompt_ids = list(self.routes)
+        if self.on_reconnect and prompt_ids:
+            self.on_reconnect(prompt_ids)
+
+    def _read_messages(self):
+        while not self.closed:
+            try:
+                out = self.ws.recv()
+            except websocket.WebSocketTimeoutException:
+                try:
+                    self.ws.ping()
+                except (OSError, websocket.WebSocketException):
+                    self._reconnect()
+                continue
+            except (OSError, websocket.WebSocketException):
+                if not self.closed:
+                    self._reconnect()
+                continue
+
+            if isinstance(out, str):
+                if not out:
+                    # The server closed the connection
+                    if not self.closed:
+                        self._reconnect()
+                    continue
+                self.dispatch(json.loads(out))
+
+    def dispatch(self, message):
+        data = message.get("data")
+        prompt_id = data.get("prompt_id") if isinstance(data, dict) else None
+        if prompt_id is None:
+            return
+
+        # Timings are taken from when messages arrive, not when they are read
+        message.setdefault("received_at", time.perf_counter())
+        with self.lock:
+            messages = self.routes.get(prompt_id)
+            if messages is not None:
+                messages.put(message)
+                return
+
+            self.unclaimed.setdefault(prompt_id, []).append(message)
+            self.unclaimed.move_to_end(prompt_id)
+            while len(self.unclaimed) > MAX_UNCLAIMED_PROMPTS:
+                self.unclaimed.popitem(last=False)
+
+    # Messages for prompt_id are put on the messages queue from now on,
+    # including any that arrived before it was routed
+    def route(self, prompt_id, messages):
+        with self.lock:
+            self.routes[prompt_id] = messages
+            for message in self.unclaimed.pop(prompt_id, []):
+                messages.put(message)
+
+    def unroute(self, prompt_id):
+        with self.lock:
+            self.routes.pop(prompt_id, None)
+            self.unclaimed.pop(prompt_id, None)
+
+    def subscribe(self):
+        return queue.Queue()
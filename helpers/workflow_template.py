@@ -0,0 +1,47 @@
+import copy
+import json
+
+
+# A workflow parsed once and compiled into variants ahead of time.
+# Each variant is the workflow with its structural changes already applied
+# (nodes or inputs removed, class types swapped) plus a set of named slots,
+# the (node_id, input_name) pairs a request parameter is written to.
+#
+# Rendering a variant only copies the nodes whose slots are being patched,
+# every other node is shared with the template and must not be modified.
+class WorkflowTemplate:
+    def __init__(self, workflow_json):
+        self.workflow = json.loads(workflow_json)
+        self.variants = {}
+
+    def add_variant(self, key, transform, slots):
+        workflow = copy.deepcopy(self.workflow)
+        transform(workflow)
+
+        for name, targets in slots.items():
+            for node_id, input_name in targets:
+                if "inputs" not in workflow.get(node_id, {}):
+                    raise ValueError(
+                        f"Slot {name} in variant {key} points at missing node {node_id}"
+                    )
+
+        self.variants[key] = (workflow, slots)
+
+    def render(self, key, **values):
+        workflow, slots = self.variants[key]
+
+        unknown = values.keys() - slots.keys()
+        if unknown:
+            raise ValueError(f"Unknown slots for variant {key}: {sorted(unknown)}")
+
+        rendered = dict(workflow)
+        for name, value in values.items():
+            for node_id, input_name in slots[name]:
+                node = rendered[node_id]
+                if node is workflow[node_id]:
+                    node = dict(node)
+                    node["inputs"] = dict(node["inputs"])
+                    rendered[node_id] = node
+                node["inputs"][input_name] = value
+
+        return rendered
@@ -1,112 +1,373 @@
+import io
+import math
 import os
 import shutil
-import json
+import functools
 import random
+import tempfile
+import threading
+import time
 import subprocess
-from typing import List
+import uuid
+from contextlib import contextmanager
+from typing import Iterator
 from cog import BasePredictor, Input, Path
-from helpers.comfyui import ComfyUI
+from PIL import Image
+from helpers.comfyui import (
+    ComfyUI,
+    PromptTimeoutError,
+    PROMPT_TIMEOUT,
+    WEIGHTS_FILETYPES,
+)
+from helpers.video_encoder import FrameEncoder
+from helpers.workflow_template import WorkflowTemplate
+from helpers.disk_cache import DiskCache, file_sha256
+from helpers.preprocessor_cache import PreprocessorCache
+from helpers.result_cache import ResultCache
+from helpers.merge_masks import merge_masks, mask_to_png
+from helpers.frame_interpolation import KeyframeInterpolator, keyframe_numbers
+from helpers.trace import Trace, TRACE_FORMATS
+from helpers.timeline import Timeline
 
 OUTPUT_DIR = "/tmp/outputs"
 INPUT_DIR = "/tmp/inputs"
 COMFYUI_TEMP_OUTPUT_DIR = "ComfyUI/temp"
 
+# Inputs are kept between predictions, named by their content, so ComfyUI
+# can reuse cached results for images it has already seen
+INPUT_CACHE_MAX_BYTES = 2 * 1024**3
+PREPROCESSOR_CACHE_MAX_BYTES = 512 * 1024**2
+
+# With a fixed seed a prediction is deterministic, so its outputs are kept
+# and returned again for an identical request
+RESULT_CACHE_DIR = "/tmp/results"
+RESULT_CACHE_MAX_BYTES = 2 * 1024**3
+
+# How many animation frames to keep queued on the ComfyUI server at once
+ANIMATION_QUEUE_WINDOW = 8
+ANIMATION_FPS = 12
+
+# COMFYUI_PROMPT_TIMEOUT is the deadline for sampling this many steps of one
+# image, a prompt that samples more gets proportionally longer
+PROMPT_TIMEOUT_STEPS = 20
+
+MERGE_MODES = ["full", "left_right", "top_bottom"]
+ANIMATION_MODES = ["exact", "interpolated"]
+
+# A tiny one-step prompt is run through the workflow variants at setup, so
+# models are loaded before the first request. "all" runs every variant,
+# "minimal" only the one that uses every model, "none" skips the warm-up.
+# "all" is 12 prompts on every cold boot, 6 of them through
+# UltimateSDUpscale, set COMFYUI_WARMUP=minimal where boot time matters.
+# A variant that fails to execute fails setup, a timeout is only logged.
+WARMUP = os.environ.get("COMFYUI_WARMUP", "all")
+WARMUP_MODES = ["all", "minimal", "none"]
+WARMUP_SIZE = 128
+
 with open("workflow.json", "r") as file:
     workflow_json = file.read()
 
 
 class Predictor(BasePredictor):
     def setup(self):
-        self.comfyUI = ComfyUI("127.0.0.1:8188")
-        self.comfyUI.start_server(OUTPUT_DIR, INPUT_DIR)
-        self.comfyUI.load_workflow(workflow_json, handle_inputs=False)
-
+        self.setup_state(ComfyUI("127.0.0.1:8188"))
+        self.comfyUI.start_server(OUTPUT_DIR, INPUT_DIR, workflow=workflow_json)
+        self.warm_up()
+
+    # Everything a prediction needs apart from the running server, so the
+    # benchmark can set up a predictor against its fake server
+    def setup_state(self, comfyUI):
+        self.input_cache = DiskCache(INPUT_DIR, INPUT_CACHE_MAX_BYTES)
+        self.preprocessor_cache = PreprocessorCache(
+            INPUT_DIR, PREPROCESSOR_CACHE_MAX_BYTES
+        )
+        self.result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+        self.active_requests = set()
+        self.requests_lock = threading.Lock()
+        self.comfyUI = comfyUI
+        self.workflow_template = self.compile_workflow_template()
+
+    # Removes the outputs of every finished prediction. Previews in
+    # ComfyUI/temp are not named by request, so they are only removed when
+    # no prediction is running, holding the lock so none starts meanwhile.
     def cleanup(self):
-        for directory in [OUTPUT_DIR, INPUT_DIR, COMFYUI_TEMP_OUTPUT_DIR]:
-            if os.path.exists(directory):
-                shutil.rmtree(directory)
-            os.makedirs(directory)
-
-    def handle_input_files(self, image_1, image_2, controlnet_image):
-        image_1_filename = f"left{os.path.splitext(image_1)[1]}"
-        image_2_filename = f"right{os.path.splitext(image_2)[1]}"
-        shutil.copy(image_1, os.path.join(INPUT_DIR, image_1_filename))
-        shutil.copy(image_2, os.path.join(INPUT_DIR, image_2_filename))
+        with self.requests_lock:
+            if not self.active_requests:
+                self.remove_entries(COMFYUI_TEMP_OUTPUT_DIR)
+        self.remove_entries(OUTPUT_DIR, skip=self.is_active_request)
+
+    def is_active_request(self, name):
+        with self.requests_lock:
+            return name in self.active_requests
+
+    def remove_entries(self, directory, skip=None):
+        os.makedirs(directory, exist_ok=True)
+        with os.scandir(directory) as entries:
+            entries = list(entries)
+        for entry in entries:
+            if skip is not None and skip(entry.name):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    # Each prediction writes its outputs to its own subdirectory, and pins the
+    # cached inputs it uses so other predictions cannot evict them. cog only
+    # overlaps predictions when predict is async, so as a sync generator it
+    # still runs one prediction at a time.
+    @contextmanager
+    def request_scope(self):
+        request_id = uuid.uuid4().hex[:12]
+        with self.requests_lock:
+            self.active_requests.add(request_id)
+        os.makedirs(os.path.join(OUTPUT_DIR, request_id))
+        try:
+            yield request_id
+        finally:
+            self.input_cache.unpin(request_id)
+            self.preprocessor_cache.unpin(request_id)
+            self.result_cache.unpin(request_id)
+            with self.requests_lock:
+                self.active_requests.discard(request_id)
+
+    def handle_input_files(self, request_id, image_1, image_2, controlnet_image):
+        image_1_filename = self.stage_input(request_id, image_1)
+        image_2_filename = self.stage_input(request_id, image_2)
+        controlnet_filename = (
+            self.stage_input(request_id, controlnet_image) if controlnet_image else None
+        )
+        return image_1_filename, image_2_filename, controlnet_filename
+
+    # Inputs are named by a hash of their contents, so the same image always
+    # has the same filename and is only written to the input directory once
+    def stage_input(self, request_id, path):
+        filename = f"{file_sha256(path)[:32]}{os.path.splitext(path)[1]}"
+        self.input_cache.pin(request_id, [filename])
+        self.input_cache.put_file(filename, path)
+        return filename
+
+    # Merge masks are generated here rather than in the workflow, all offsets
+    # in one go, and kept in the input directory for the next request
+    def stage_merge_masks(self, request_id, merge_mode, width, height, offsets):
+        filenames = [
+            f"mask_{merge_mode}_{width}x{height}_{offset}.png" for offset in offsets
+        ]
+        self.input_cache.pin(request_id, filenames)
+        missing = [
+            i
+            for i, filename in enumerate(filenames)
+            if not self.input_cache.get(filename)
+        ]
+        if missing:
+            masks = merge_masks(
+                merge_mode, width, height, [offsets[i] for i in missing]
+            )
+            for i, mask in zip(missing, masks):
+                self.input_cache.put_bytes(filenames[i], mask_to_png(mask))
+        return filenames
 
-        if controlnet_image:
-            controlnet_filename = f"controlnet{os.path.splitext(controlnet_image)[1]}"
-            shutil.copy(controlnet_image, os.path.join(INPUT_DIR, controlnet_filename))
-            return image_1_filename, image_2_filename, controlnet_filename
+    def warmup_variants(self):
+        if WARMUP not in WARMUP_MODES:
+            raise ValueError(
+                f"Unknown COMFYUI_WARMUP {WARMUP}, expected one of {WARMUP_MODES}"
+            )
+        if WARMUP == "none":
+            return []
+
+        # This variant loads every model, so it runs first
+        variants = [("left_right", True, True, False)]
+        if WARMUP == "all":
+            variants += [
+                variant
+                for variant in self.workflow_template.variants
+                if variant not in variants and not variant[3]
+            ]
+        return variants
 
-        return image_1_filename, image_2_filename, None
+    def warm_up(self):
+        variants = self.warmup_variants()
+        if not variants:
+            print("Skipping warm-up")
+            return
 
-    def update_workflow(
-        self,
-        workflow,
-        image_1_filename,
-        image_1_weight,
-        image_2_filename,
-        image_2_weight,
-        width,
-        height,
-        steps,
-        control_image,
-        prompt,
-        negative_prompt,
-        seed,
-        is_upscale,
-        upscale_steps,
-        merge_mode,
+        timeline = Timeline("Warm-up")
+        self.comfyUI.connect()
+        with self.request_scope() as request_id:
+            images = self.stage_warmup_images(request_id)
+            failed = []
+            for variant in variants:
+                trace = Trace(f"Warm-up {variant}")
+                workflow = self.workflow_template.render(
+                    variant, **self.warmup_values(variant, request_id, images)
+                )
+                with timeline.phase(f"Warm-up {variant}"):
+                    try:
+                        self.comfyUI.run_workflow(workflow, optimize=True, trace=trace)
+                    except PromptTimeoutError as e:
+                        print(f"Warm-up of {variant} timed out: {e}")
+                        failed.append(variant)
+                        continue
+                self.log_model_load_times(variant, workflow, trace)
+        timeline.log()
+        if len(failed) == len(variants):
+            raise RuntimeError(f"Warm-up failed for every variant: {failed}")
+
+    def stage_warmup_images(self, request_id):
+        images = {}
+        for name, color in [
+            ("image_1", (200, 60, 60)),
+            ("image_2", (60, 60, 200)),
+            ("control_image", (60, 200, 60)),
+        ]:
+            buffer = io.BytesIO()
+            Image.new("RGB", (WARMUP_SIZE, WARMUP_SIZE), color).save(
+                buffer, format="PNG"
+            )
+            images[name] = f"warmup_{name}.png"
+            self.input_cache.pin(request_id, [images[name]])
+            self.input_cache.put_bytes(images[name], buffer.getvalue())
+        return images
+
+    def warmup_values(self, variant, request_id, images):
+        merge_mode, has_control_image, is_upscale, _ = variant
+        values = {
+            "image_1": images["image_1"],
+            "image_1_weight": 1,
+            "image_2": images["image_2"],
+            "image_2_weight": 1,
+            "prompt": "",
+            "negative_prompt": "",
+            "width": WARMUP_SIZE,
+            "height": WARMUP_SIZE,
+            "seed": 0,
+            "steps": 1,
+            "filename_prefix": f"{request_id}/warmup",
+        }
+        if merge_mode != "full":
+            values["mask"] = self.stage_merge_masks(
+                request_id, merge_mode, WARMUP_SIZE, WARMUP_SIZE, [WARMUP_SIZE // 4]
+            )[0]
+        if has_control_image:
+            values["control_image"] = images["control_image"]
+        if is_upscale:
+            values["upscale_steps"] = 1
+        return values
+
+    # Loader and preprocessor nodes spend almost all their time loading models
+    # Later variants only report the models the earlier ones did not load
+    def log_model_load_times(self, variant, workflow, trace):
+        print(f"Model load times for {variant}:")
+        for prompt in trace.to_dict()["prompts"]:
+            for node in prompt["nodes"]:
+                inputs = workflow.get(node["node_id"], {}).get("inputs", {})
+                weights = [
+                    value
+                    for value in inputs.values()
+                    if isinstance(value, str) and value.endswith(WEIGHTS_FILETYPES)
+                ]
+                is_preprocessor = self.preprocessor_cache.is_preprocessor(
+                    workflow.get(node["node_id"], {})
+                )
+                if node["duration"] is None or not (weights or is_preprocessor):
+                    continue
+                print(
+                    f"  {node['duration']:7.2f}s  {node['title']} ({node['class_type']})"
+                    + (f": {', '.join(weights)}" if weights else "")
+                )
+
+    # Every image in a batch is sampled, and an upscale samples each tile of
+    # the upscaled images again
+    def prompt_timeout(self, width, height, steps, batch_size=1, upscale_steps=0):
+        upscaler = self.workflow_template.workflow["71"]["inputs"]
+        tiles = math.ceil(
+            width * upscaler["upscale_by"] / upscaler["tile_width"]
+        ) * math.ceil(height * upscaler["upscale_by"] / upscaler["tile_height"])
+        work = batch_size * (steps + tiles * upscale_steps)
+        return PROMPT_TIMEOUT * max(1, work / PROMPT_TIMEOUT_STEPS)
+
+    def write_trace(self, trace, request_id, trace_format):
+        trace_path = os.path.join(OUTPUT_DIR, request_id, f"trace_{trace_format}.json")
+        return trace.write(trace_path, trace_format)
+
+    # Links a chunk of frame masks into a directory, in frame order, for the
+    # batch variant to load in one go
+    def stage_mask_batch(self, mask_filenames, directory):
+        os.makedirs(directory)
+        for i, filename in enumerate(mask_filenames):
+            os.link(
+                os.path.join(INPUT_DIR, filename),
+                os.path.join(directory, f"{i:05d}.png"),
+            )
+        return directory
+
+    def compile_workflow_template(self):
+        template = WorkflowTemplate(workflow_json)
+        for merge_mode in MERGE_MODES:
+            for has_control_image in [True, False]:
+                for is_upscale in [True, False]:
+                    for is_batch in [False, True] if merge_mode != "full" else [False]:
+                        variant = (merge_mode, has_control_image, is_upscale, is_batch)
+                        template.add_variant(
+                            variant,
+                            functools.partial(self.apply_variant, *variant),
+                            self.variant_slots(*variant),
+                        )
+        return template
+
+    # Structural changes to the workflow, applied once per variant at setup
+    def apply_variant(
+        self, merge_mode, has_control_image, is_upscale, is_batch, workflow
     ):
-        efficient_loader = workflow["4"]["inputs"]
         upscaler = workflow["71"]["inputs"]
-        sampler = workflow["8"]["inputs"]
-        ip_adapter_1 = workflow["62"]["inputs"]
-        ip_adapter_2 = workflow["61"]["inputs"]
-
-        ip_adapter_1["weight"] = image_1_weight
-        ip_adapter_2["weight"] = image_2_weight
-
-        efficient_loader["positive"] = prompt
-        efficient_loader["negative"] = negative_prompt
-        efficient_loader["empty_latent_width"] = width
-        efficient_loader["empty_latent_height"] = height
-
-        sampler["seed"] = seed
-        sampler["steps"] = steps
 
         if merge_mode == "full":
-            del ip_adapter_1["attn_mask"]
-            del ip_adapter_2["attn_mask"]
-        else:
-            workflow["56"]["inputs"]["width"] = width
-            workflow["56"]["inputs"]["height"] = height
-            workflow["58"]["inputs"]["width"] = width
-            workflow["58"]["inputs"]["height"] = height
-
-            if merge_mode == "top_bottom":
-                workflow["57"]["inputs"]["top"] = height // 2
-                offset = height // 4
-            elif merge_mode == "left_right":
-                workflow["57"]["inputs"]["left"] = width // 2
-                offset = width // 4
-
-            self.set_mask_offset(workflow, merge_mode, offset)
-
-        if not control_image:
-            del efficient_loader["cnet_stack"]
-
-            # Hack to stop erroring on missing file
-            workflow["20"]["inputs"]["image"] = image_1_filename
+            del workflow["62"]["inputs"]["attn_mask"]
+            del workflow["61"]["inputs"]["attn_mask"]
         else:
-            workflow["20"]["inputs"]["image"] = control_image
-
-        workflow["10"]["inputs"]["image"] = image_1_filename
-        workflow["25"]["inputs"]["image"] = image_2_filename
+            # The mask is generated by stage_merge_masks instead of the
+            # SolidMask, FeatherMask and MaskComposite nodes
+            workflow["59"] = {
+                "inputs": {"image": "mask.png", "channel": "red", "upload": "image"},
+                "class_type": "LoadImageMask",
+                "_meta": {"title": "Load Merge Mask"},
+            }
+            del workflow["56"]
+            del workflow["57"]
+            del workflow["58"]
+
+        if is_batch:
+            # A batch of animation frames, each with its own mask, sampled
+            # together in one prompt. Every frame uses the same noise.
+            workflow["100"] = {
+                "inputs": {
+                    "directory": "",
+                    "image_load_cap": 0,
+                    "skip_first_images": 0,
+                    "select_every_nth": 1,
+                },
+                "class_type": "VHS_LoadImagesPath",
+                "_meta": {"title": "Load Merge Mask Batch"},
+            }
+            workflow["59"] = {
+                "inputs": {"image": ["100", 0], "channel": "red"},
+                "class_type": "ImageToMask",
+                "_meta": {"title": "Convert Image to Mask"},
+            }
+            workflow["101"] = {
+                "inputs": {"samples": ["4", 3], "seed_behavior": "fixed"},
+                "class_type": "LatentBatchSeedBehavior",
+                "_meta": {"title": "LatentBatchSeedBehavior"},
+            }
+            workflow["8"]["inputs"]["latent_image"] = ["101", 0]
+
+        if not has_control_image:
+            del workflow["4"]["inputs"]["cnet_stack"]
 
         if is_upscale:
-            upscaler["seed"] = seed
-            upscaler["steps"] = upscale_steps
             workflow["9"]["class_type"] = "PreviewImage"
         else:
             del workflow["72"]
@@ -116,25 +377,47 @@ class Predictor(BasePredictor):
             del upscaler["negative"]
             del upscaler["vae"]
 
-    def set_mask_offset(self, workflow, merge_mode, offset):
-        if merge_mode == "left_right":
-            workflow["59"]["inputs"]["x"] = offset
-        elif merge_mode == "top_bottom":
-            workflow["59"]["inputs"]["y"] = offset
+    # Where each request parameter is written to in a variant
+    def variant_slots(self, merge_mode, has_control_image, is_upscale, is_batch):
+        slots = {
+            "image_1": [("10", "image")],
+            "image_1_weight": [("62", "weight")],
+            "image_2": [("25", "image")],
+            "image_2_weight": [("61", "weight")],
+            "prompt": [("4", "positive")],
+            "negative_prompt": [("4", "negative")],
+            "width": [("4", "empty_latent_width")],
+            "height": [("4", "empty_latent_height")],
+            "seed": [("8", "seed")],
+            "steps": [("8", "steps")],
+            "filename_prefix": (
+                [("72", "filename_prefix")]
+                if is_upscale
+                else [("9", "filename_prefix")]
+            ),
+        }
+
+        if is_batch:
+            slots["mask_directory"] = [("100", "directory")]
+            slots["batch_size"] = [("4", "batch_size")]
+        elif merge_mode != "full":
+            slots["mask"] = [("59", "image")]
+
+        if has_control_image:
+            slots["control_image"] = [("20", "image")]
+        else:
+            # Hack to stop erroring on missing file
+            slots["image_1"].append(("20", "image"))
 
-    def log_and_collect_files(self, directory, prefix=""):
-        files = []
-        for f in os.listdir(directory):
-            if f == "__MACOSX":
-                continue
-            path = os.path.join(directory, f)
-            if os.path.isfile(path):
-                print(f"{prefix}{f}")
-                files.append(Path(path))
-            elif os.path.isdir(path):
-                print(f"{prefix}{f}/")
-                files.extend(self.log_and_collect_files(path, prefix=f"{prefix}{f}/"))
-        return files
+        if is_upscale:
+            slots["seed"].append(("71", "seed"))
+            slots["upscale_steps"] = [("71", "steps")]
+
+        return slots
+
+    # Paths of the images written to the output directory by SaveImage nodes
+    def saved_images(self, outputs):
+        return [output["path"] for output in outputs if output["type"] == "output"]
 
     def predict(
         self,
@@ -148,7 +431,7 @@ class Predictor(BasePredictor):
         ),
         merge_mode: str = Input(
             default="full",
-            choices=["full", "left_right", "top_bottom"],
+            choices=MERGE_MODES,
             description="The mode to use for merging the images",
         ),
         prompt: str = Input(
@@ -174,112 +457,306 @@ class Predictor(BasePredictor):
         ),
         animate: bool = Input(
             default=False,
-            description="Animate merging from one image to the other. Only the video is returned.",
+            description="Animate merging from one image to the other. Each frame is returned as soon as it is generated, followed by the video.",
         ),
         animate_frames: int = Input(
-            default=24, description="The number of frames to generate for the animation"
+            default=24,
+            ge=1,
+            description="The number of frames to generate for the animation",
+        ),
+        animate_batch_size: int = Input(
+            default=1,
+            ge=1,
+            description="The number of animation frames to sample together in one batch. Higher is faster but uses more memory.",
+        ),
+        animation_mode: str = Input(
+            default="exact",
+            choices=ANIMATION_MODES,
+            description="exact generates every frame. interpolated only generates keyframes and crossfades between them, which is much faster.",
+        ),
+        keyframe_interval: int = Input(
+            default=4,
+            ge=1,
+            description="With interpolated animations, generate every nth frame as a keyframe",
         ),
         return_temp_files: bool = Input(
             description="Return any temporary files, such as preprocessed controlnet images. Useful for debugging.",
             default=False,
         ),
-    ) -> List[Path]:
+        return_trace: str = Input(
+            description="Return a trace of how long each node took to run, as JSON or in Chrome trace event format (open it in Perfetto or chrome://tracing)",
+            choices=["none"] + TRACE_FORMATS,
+            default="none",
+        ),
+    ) -> Iterator[Path]:
         """Run a single prediction on the model"""
         self.cleanup()
 
-        if not image_1 or not image_2:
-            raise ValueError("Please provide two input images")
-
-        if animate and (merge_mode == "full" or not control_image):
-            raise ValueError(
-                "Animation is only supported for left_right and top_bottom merge modes with a control image"
-            )
-
-        (
-            image_1_filename,
-            image_2_filename,
-            controlnet_filename,
-        ) = self.handle_input_files(image_1, image_2, control_image)
-
-        if seed is None:
-            seed = random.randint(0, 2**32 - 1)
-            print(f"Random seed set to: {seed}")
-
-        workflow = json.loads(workflow_json)
-
-        self.update_workflow(
-            workflow,
-            image_1_filename,
-            image_1_strength,
-            image_2_filename,
-            image_2_strength,
-            width,
-            height,
-            steps,
-            controlnet_filename,
-            prompt,
-            negative_prompt,
-            seed,
-            upscale_2x,
-            upscale_steps,
-            merge_mode,
-        )
-
-        wf = self.comfyUI.load_workflow(workflow)
-        self.comfyUI.connect()
-
-        if animate:
-            dimension = width if merge_mode == "left_right" else height
-            step_size = max(
-                1,
-                dimension // animate_frames,
+        with self.request_scope() as request_id:
+
+            if not image_1 or not image_2:
+                raise ValueError("Please provide two input images")
+
+            if animate and (merge_mode == "full" or not control_image):
+                raise ValueError(
+                    "Animation is only supported for left_right and top_bottom merge modes with a control image"
+                )
+
+            (
+                image_1_filename,
+                image_2_filename,
+                controlnet_filename,
+            ) = self.handle_input_files(request_id, image_1, image_2, control_image)
+
+            fixed_seed = seed is not None
+            if seed is None:
+                seed = random.randint(0, 2**32 - 1)
+                print(f"Random seed set to: {seed}")
+
+            variant = (merge_mode, controlnet_filename is not None, upscale_2x, False)
+            values = {
+                "image_1": image_1_filename,
+                "image_1_weight": image_1_strength,
+                "image_2": image_2_filename,
+                "image_2_weight": image_2_strength,
+                "prompt": prompt,
+                "negative_prompt": negative_prompt,
+                "width": width,
+                "height": height,
+                "seed": seed,
+                "steps": steps,
+                "filename_prefix": f"{request_id}/ComfyUI",
+            }
+
+            # The frames that are diffused, the rest are interpolated
+            frame_numbers = [0]
+            if animate:
+                frame_numbers = list(range(animate_frames))
+                if animation_mode == "interpolated":
+                    frame_numbers = keyframe_numbers(animate_frames, keyframe_interval)
+
+            mask_filenames = []
+            if merge_mode != "full":
+                dimension = width if merge_mode == "left_right" else height
+                if animate:
+                    step_size = max(
+                        1,
+                        dimension // animate_frames,
+                    )
+                    print(f"Dimension: {dimension}")
+                    print(f"Step size: {step_size}")
+                    offsets = [
+                        max(1, step_size * frame_number)
+                        for frame_number in frame_numbers
+                    ]
+                else:
+                    offsets = [dimension // 4]
+
+                mask_filenames = self.stage_merge_masks(
+                    request_id, merge_mode, width, height, offsets
+                )
+                values["mask"] = mask_filenames[0]
+
+            self.input_cache.evict()
+
+            if controlnet_filename:
+                values["control_image"] = controlnet_filename
+
+            if upscale_2x:
+                values["upscale_steps"] = upscale_steps
+
+            workflow = self.workflow_template.render(variant, **values)
+
+            trace = Trace("Prediction")
+            result_key = None
+            if fixed_seed:
+                options = {"return_temp_files": return_temp_files}
+                if animate:
+                    options.update(
+                        animate_frames=animate_frames,
+                        animate_batch_size=animate_batch_size,
+                        frame_numbers=frame_numbers,
+                        mask_filenames=mask_filenames,
+                    )
+                result_key = self.result_cache.cache_key(workflow, options)
+                cached = self.result_cache.lookup(result_key, request_id)
+                trace.result_cache = {
+                    "key": result_key,
+                    "hit": bool(cached),
+                    "files": len(cached or []),
+                }
+                if cached:
+                    print(
+                        f"Result cache hit for {result_key}, returning {len(cached)} cached files"
+                    )
+                    for path in self.result_cache.restore(
+                        cached, os.path.join(OUTPUT_DIR, request_id)
+                    ):
+                        yield Path(path)
+                    # The trace only records the hit, nothing was run
+                    if return_trace != "none":
+                        yield Path(self.write_trace(trace, request_id, return_trace))
+                    return
+                print(f"Result cache miss for {result_key}")
+
+            wf = self.comfyUI.load_workflow(workflow)
+
+            # Without a control image the preprocessors are pruned before running
+            preprocessor_hits, preprocessor_misses = {}, {}
+            if controlnet_filename:
+                preprocessor_hits, preprocessor_misses = self.preprocessor_cache.lookup(
+                    wf
+                )
+                self.preprocessor_cache.pin(request_id, preprocessor_hits)
+                print(
+                    f"Preprocessor cache: {len(preprocessor_hits)} hits, {len(preprocessor_misses)} misses"
+                )
+                wf = self.preprocessor_cache.swap(wf, preprocessor_hits)
+
+            # Previews of missed preprocessors are where their output is cached from
+            keep_nodes = list(
+                self.preprocessor_cache.preview_nodes(wf, preprocessor_misses).values()
             )
-            print(f"Dimension: {dimension}")
-            print(f"Step size: {step_size}")
-            for frame_number in range(animate_frames):
-                offset = max(1, step_size * frame_number)
-                print(f"Running frame {frame_number + 1} of {animate_frames}")
-                print(f"Offset: {offset}")
-                self.set_mask_offset(wf, merge_mode, offset)
-                self.comfyUI.run_workflow(wf)
-        else:
-            self.comfyUI.run_workflow(wf)
-
-        files = []
-        output_directories = [OUTPUT_DIR]
-
-        if return_temp_files:
-            output_directories.append(COMFYUI_TEMP_OUTPUT_DIR)
-
-        for directory in output_directories:
-            print(f"Contents of {directory}:")
-            files.extend(self.log_and_collect_files(directory))
-
-        if animate:
-            video_output_filename = os.path.join(OUTPUT_DIR, "output_video.mp4")
-            ffmpeg_command = [
-                "ffmpeg",
-                "-r",
-                "12",
-                "-pattern_type",
-                "glob",
-                "-i",
-                f"{OUTPUT_DIR}/*.png",  # Use file order and only PNG images
-                "-c:v",
-                "libx264",  # Video codec to be used
-                "-pix_fmt",
-                "yuv420p",  # Pixel format for compatibility
-                "-vf",
-                "format=yuv420p",  # Set the video format to yuv420p
-                "-y",  # Overwrite output file if it exists
-                video_output_filename,  # Output filename
-            ]
-            try:
-                subprocess.run(ffmpeg_command, check=True)
-                print(f"Video successfully created at {video_output_filename}")
-            except subprocess.CalledProcessError as e:
-                print(f"An error occurred while creating the video: {e}")
-
-            return [Path(video_output_filename)]
 
-        return files
+            # The image before upscaling is streamed while the upscale runs
+            streamed_previews = []
+            if upscale_2x and not animate:
+                streamed_previews.append("9")
+                keep_nodes.append("9")
+            self.comfyUI.connect()
+            # Everything returned except the trace, to store in the result cache
+            results = []
+
+            if animate:
+                # Chunks hold positions in frame_numbers, offsets and mask_filenames
+                batch_size = min(animate_batch_size, len(frame_numbers))
+                chunks = [
+                    list(range(start, min(start + batch_size, len(frame_numbers))))
+                    for start in range(0, len(frame_numbers), batch_size)
+                ]
+                batch_variant = (*variant[:3], True)
+                batch_values = {k: v for k, v in values.items() if k != "mask"}
+                batch_directory = tempfile.mkdtemp(
+                    prefix="mask_batches_", dir=INPUT_DIR
+                )
+
+                def prompts():
+                    for chunk_number, chunk in enumerate(chunks):
+                        print(
+                            f"Queueing frames {[frame_numbers[i] + 1 for i in chunk]} of {animate_frames}"
+                        )
+                        print(f"Offsets: {[offsets[i] for i in chunk]}")
+                        if batch_size == 1:
+                            workflow = self.workflow_template.render(
+                                variant, **{**values, "mask": mask_filenames[chunk[0]]}
+                            )
+                        else:
+                            workflow = self.workflow_template.render(
+                                batch_variant,
+                                **batch_values,
+                                batch_size=len(chunk),
+                                mask_directory=self.stage_mask_batch(
+                                    [mask_filenames[i] for i in chunk],
+                                    os.path.join(
+                                        batch_directory, f"{chunk_number:05d}"
+                                    ),
+                                ),
+                            )
+                        yield self.preprocessor_cache.swap(workflow, preprocessor_hits)
+
+                video_output_filename = os.path.join(
+                    OUTPUT_DIR, request_id, "output_video.mp4"
+                )
+                encoder = FrameEncoder(video_output_filename, fps=ANIMATION_FPS).start()
+                interpolator = KeyframeInterpolator(encoder, frame_numbers)
+
+                start = time.time()
+                try:
+                    # Frames are streamed as they finish, which may be out of order
+                    for chunk_number, outputs in self.comfyUI.stream_workflows(
+                        prompts(),
+                        max_in_flight=ANIMATION_QUEUE_WINDOW,
+                        optimize=True,
+                        keep_previews=return_temp_files,
+                        keep_nodes=keep_nodes,
+                        trace=trace,
+                        timeout=self.prompt_timeout(
+                            width,
+                            height,
+                            steps,
+                            batch_size,
+                            upscale_steps if upscale_2x else 0,
+                        ),
+                    ):
+                        if chunk_number == 0:
+                            self.preprocessor_cache.store(
+                                wf, preprocessor_misses, outputs
+                            )
+                        for i, image in zip(
+                            chunks[chunk_number], self.saved_images(outputs)
+                        ):
+                            interpolator.add_keyframe(frame_numbers[i], image)
+                            results.append(image)
+                            yield Path(image)
+                except BaseException:
+                    encoder.abort()
+                    raise
+                finally:
+                    shutil.rmtree(batch_directory, ignore_errors=True)
+
+                elapsed_time = time.time() - start
+                print(
+                    f"Sampled {len(frame_numbers)} frames in batches of {batch_size} in {elapsed_time:.2f}s "
+                    f"({len(frame_numbers) / elapsed_time:.2f} frames/s)"
+                )
+                if interpolator.interpolated_frames:
+                    print(
+                        f"Interpolated {interpolator.interpolated_frames} frames, "
+                        f"saving {animate_frames - len(frame_numbers)} of {animate_frames} diffusion runs"
+                    )
+            else:
+                outputs = []
+                for output in self.comfyUI.stream_workflow(
+                    wf,
+                    optimize=True,
+                    keep_previews=return_temp_files,
+                    keep_nodes=keep_nodes,
+                    trace=trace,
+                    timeout=self.prompt_timeout(
+                        width,
+                        height,
+                        steps,
+                        upscale_steps=upscale_steps if upscale_2x else 0,
+                    ),
+                ):
+                    outputs.append(output)
+                    if (
+                        output["type"] == "output"
+                        or output["node_id"] in streamed_previews
+                        or (return_temp_files and output["type"] == "temp")
+                    ):
+                        results.append(output["path"])
+                        yield Path(output["path"])
+                self.preprocessor_cache.store(wf, preprocessor_misses, outputs)
+
+            if animate:
+                try:
+                    encoder.finish()
+                    print(f"Video successfully created at {video_output_filename}")
+                    results.append(video_output_filename)
+                    yield Path(video_output_filename)
+                except subprocess.CalledProcessError as e:
+                    print(f"An error occurred while creating the video: {e}")
+                    # Without the video the result is incomplete
+                    result_key = None
+
+            if result_key is not None:
+                self.result_cache.store(result_key, results)
+
+            trace.log()
+            if return_trace != "none":
+                yield Path(self.write_trace(trace, request_id, return_trace))
+
+            trace.http_stats.log()
+            trace.cache_stats.log()
+            self.comfyUI.check_memory()
@@ -0,0 +1,274 @@
+import argparse
+import inspect
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from PIL import Image
+
+import predict
+from helpers.comfyui import ComfyUI
+from fake_comfyui_server import FakeComfyUI
+
+# Measures the overhead of the predictor around ComfyUI: input staging,
+# workflow rendering, HTTP and websocket handling, output collection and
+# video encoding. ComfyUI is replaced by the in-process fake server, so no
+# GPU, weights or network are needed. ffmpeg is needed for animations.
+
+# Scenarios run without a seed, so every iteration is actually run, unless
+# they give one to measure result cache hits
+SCENARIOS = {
+    "full": {"merge_mode": "full"},
+    "full_result_cached": {"merge_mode": "full", "seed": 1},
+    "full_upscale": {"merge_mode": "full", "upscale_2x": True},
+    "left_right": {"merge_mode": "left_right", "control": True},
+    "top_bottom_upscale": {"merge_mode": "top_bottom", "upscale_2x": True},
+    "animate_8": {
+        "merge_mode": "left_right",
+        "control": True,
+        "animate": True,
+        "animate_frames": 8,
+    },
+    "animate_24": {
+        "merge_mode": "left_right",
+        "control": True,
+        "animate": True,
+        "animate_frames": 24,
+    },
+    "animate_24_batched": {
+        "merge_mode": "left_right",
+        "control": True,
+        "animate": True,
+        "animate_frames": 24,
+        "animate_batch_size": 8,
+    },
+    "animate_24_interpolated": {
+        "merge_mode": "left_right",
+        "control": True,
+        "animate": True,
+        "animate_frames": 24,
+        "animation_mode": "interpolated",
+    },
+}
+
+
+def make_predictor(port):
+    comfyUI = ComfyUI(f"127.0.0.1:{port}")
+    comfyUI.input_directory = predict.INPUT_DIR
+    comfyUI.output_directory = predict.OUTPUT_DIR
+    # The fake server does not load models, so there are no weights to fetch
+    comfyUI.handle_weights = lambda workflow: None
+    predictor = predict.Predictor()
+    predictor.setup_state(comfyUI)
+    return predictor
+
+
+def make_inputs(directory):
+    paths = {}
+    for name, color in [
+        ("image_1", (200, 60, 60)),
+        ("image_2", (60, 60, 200)),
+        ("control_image", (60, 200, 60)),
+    ]:
+        path = os.path.join(directory, f"{name}.png")
+        Image.new("RGB", (768, 768), color).save(path)
+        paths[name] = predict.Path(path)
+    return paths
+
+
+# Every predict input at its default, so predict can be called directly
+def default_inputs(predictor):
+    inputs = {}
+    for name, parameter in inspect.signature(predictor.predict).parameters.items():
+        default = getattr(parameter.default, "default", parameter.default)
+        if default is not inspect.Parameter.empty and default is not ...:
+            inputs[name] = default
+    return inputs
+
+
+def predict_inputs(predictor, scenario, images):
+    inputs = default_inputs(predictor)
+    inputs.update({k: v for k, v in scenario.items() if k != "control"})
+    inputs["image_1"] = images["image_1"]
+    inputs["image_2"] = images["image_2"]
+    inputs["control_image"] = (
+        images["control_image"] if scenario.get("control") else None
+    )
+    inputs["seed"] = scenario.get("seed")
+    return inputs
+
+
+def read_proc_io():
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return {key: int(value) for key, value in counters.items()}
+    except OSError:
+        return None
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+# predict streams its outputs, so this returns the time to the first output
+# as well as the total time. Outputs must still exist once the prediction has
+# finished, which catches overlapping predictions removing each other's files.
+def consume(outputs):
+    start = time.perf_counter()
+    first = None
+    paths = []
+    for output in outputs:
+        if first is None:
+            first = time.perf_counter() - start
+        paths.append(output)
+    total = time.perf_counter() - start
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise RuntimeError(f"Outputs removed before the prediction finished: {missing}")
+    return first, total
+
+
+# With concurrency above 1, that many predictions are started at once from
+# threads, sharing the predictor and the fake server
+def run_scenario(predictor, name, inputs, iterations, quiet, concurrency=1):
+    def run_batch():
+        if concurrency == 1:
+            return [consume(predictor.predict(**inputs))]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(
+                executor.map(
+                    lambda _: consume(predictor.predict(**inputs)), range(concurrency)
+                )
+            )
+
+    def run():
+        if quiet:
+            with open(os.devnull, "w") as devnull:
+                stdout = sys.stdout
+                sys.stdout = devnull
+                try:
+                    return run_batch()
+                finally:
+                    sys.stdout = stdout
+        return run_batch()
+
+    # The first run stages inputs and masks, later runs reuse them
+    run()
+
+    latencies = []
+    first_output_latencies = []
+    io_before = read_proc_io()
+    for _ in range(iterations):
+        for first, total in run():
+            first_output_latencies.append(first)
+            latencies.append(total)
+    io_after = read_proc_io()
+
+    # Allocations are measured separately, tracemalloc slows everything down
+    tracemalloc.start()
+    run()
+    allocated, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "scenario": name,
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "first_output_p50": percentile(first_output_latencies, 50),
+        "mean": sum(latencies) / len(latencies),
+        "allocated_mb": allocated / 1024**2,
+        "peak_mb": peak / 1024**2,
+    }
+    if io_before and io_after:
+        for key in ["syscr", "syscw", "rchar", "wchar"]:
+            result[key] = (io_after[key] - io_before[key]) / (iterations * concurrency)
+    return result
+
+
+def print_results(results):
+    print(
+        f"{'scenario':<26} {'p50':>8} {'p95':>8} {'first':>8} {'peak MB':>8} {'syscr':>8} {'syscw':>8}"
+    )
+    for r in results:
+        print(
+            f"{r['scenario']:<26} {r['p50'] * 1000:7.1f}ms {r['p95'] * 1000:7.1f}ms "
+            f"{r['first_output_p50'] * 1000:7.1f}ms "
+            f"{r['peak_mb']:8.1f} {r.get('syscr', 0):8.0f} {r.get('syscw', 0):8.0f}"
+        )
+    print("Syscall counts are per prediction and include the in-process fake server")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the predictor against a fake ComfyUI"
+    )
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS)
+    )
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--port", type=int, default=8189)
+    parser.add_argument(
+        "--node-time", type=float, default=0.0, help="Simulated seconds per node"
+    )
+    parser.add_argument(
+        "--step-time",
+        type=float,
+        default=0.0,
+        help="Simulated seconds per sampler step",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Run this many predictions at once, to check they do not interfere",
+    )
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument(
+        "--verbose", action="store_true", help="Show the predictor's logs"
+    )
+    args = parser.parse_args()
+
+    FakeComfyUI(
+        predict.OUTPUT_DIR,
+        predict.COMFYUI_TEMP_OUTPUT_DIR,
+        node_time=args.node_time,
+        step_time=args.step_time,
+    ).start(port=args.port)
+    predictor = make_predictor(args.port)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        images = make_inputs(directory)
+        for name in args.scenarios:
+            print(f"Running {name}")
+            inputs = predict_inputs(predictor, SCENARIOS[name], images)
+            results.append(
+                run_scenario(
+                    predictor,
+                    name,
+                    inputs,
+                    args.iterations,
+                    not args.verbose,
+                    args.concurrency,
+                )
+            )
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
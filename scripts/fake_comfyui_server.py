@@ -0,0 +1,430 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import threading
+import time
+import uuid
+
+from aiohttp import web
+from PIL import Image
+
+# A stand-in for the ComfyUI server, for benchmarking and testing the code
+# around it without a GPU, models or network. Prompts are "executed" node by
+# node in dependency order, sending the same websocket events as ComfyUI,
+# and save and preview nodes write placeholder PNGs. Nodes of the
+# fail_class_types raise an execution_error, and prompts can be interrupted.
+# Like ComfyUI, nodes whose inputs and upstream nodes are unchanged since the
+# last prompt are reported as cached and not run again.
+
+SAVE_NODE_CLASSES = {"SaveImage"}
+PREVIEW_NODE_CLASSES = {"PreviewImage", "MaskPreview+"}
+
+
+class FakeComfyUI:
+    def __init__(
+        self,
+        output_directory,
+        temp_directory,
+        node_time=0.0,
+        step_time=0.0,
+        fail_class_types=(),
+    ):
+        self.output_directory = output_directory
+        self.temp_directory = temp_directory
+        self.node_time = node_time
+        self.step_time = step_time
+        self.fail_class_types = set(fail_class_types)
+        self.history = {}
+        self.sockets = {}
+        self.counters = {}
+        self.images = {}
+        self.prompts_run = 0
+        self.pending = {}
+        self.cached_prompt = {}
+        self.cached_outputs = {}
+        self.running = None
+        self.interrupted = False
+        self.queue = None
+        self.loop = None
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024**2)
+        app.router.add_post("/prompt", self.post_prompt)
+        app.router.add_get("/history/{prompt_id}", self.get_history)
+        app.router.add_get("/system_stats", self.get_system_stats)
+        app.router.add_get("/queue", self.get_queue)
+        app.router.add_post("/queue", self.post_queue)
+        app.router.add_post("/interrupt", self.post_interrupt)
+        app.router.add_get("/ws", self.websocket)
+        app.on_startup.append(self.start_worker)
+        return app
+
+    async def start_worker(self, app):
+        self.queue = asyncio.Queue()
+        app["worker"] = asyncio.create_task(self.worker())
+
+    async def post_prompt(self, request):
+        body = await request.json()
+        prompt_id = str(uuid.uuid4())
+        self.pending[prompt_id] = body["prompt"]
+        await self.queue.put((prompt_id, body["prompt"], body.get("client_id")))
+        return web.json_response(
+            {"prompt_id": prompt_id, "number": self.prompts_run, "node_errors": {}}
+        )
+
+    async def get_history(self, request):
+        prompt_id = request.match_info["prompt_id"]
+        if prompt_id not in self.history:
+            return web.json_response({})
+        return web.json_response({prompt_id: self.history[prompt_id]})
+
+    async def get_queue(self, request):
+        running = []
+        if self.running is not None:
+            running.append([self.prompts_run, self.running, {}, {}, []])
+        return web.json_response(
+            {
+                "queue_running": running,
+                "queue_pending": [
+                    [number, prompt_id, prompt, {}, []]
+                    for number, (prompt_id, prompt) in enumerate(
+                        self.pending.items(), start=self.prompts_run + 1
+                    )
+                ],
+            }
+        )
+
+    async def post_queue(self, request):
+        body = await request.json()
+        if body.get("clear"):
+            self.pending.clear()
+        for prompt_id in body.get("delete", []):
+            self.pending.pop(prompt_id, None)
+        return web.Response(status=200)
+
+    async def post_interrupt(self, request):
+        body = await request.json() if request.can_read_body else {}
+        prompt_id = body.get("prompt_id")
+        if self.running is not None and prompt_id in (None, self.running):
+            self.interrupted = True
+        return web.Response(status=200)
+
+    async def get_system_stats(self, request):
+        return web.json_response(
+            {
+                "system": {
+                    "os": "posix",
+                    "python_version": "",
+                    "embedded_python": False,
+                },
+                "devices": [
+                    {
+                        "name": "cpu",
+                        "type": "cpu",
+                        "index": None,
+                        "vram_total": 0,
+                        "vram_free": 0,
+                        "torch_vram_total": 0,
+                        "torch_vram_free": 0,
+                    }
+                ],
+            }
+        )
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client_id = request.query.get("clientId") or str(uuid.uuid4())
+        self.sockets[client_id] = ws
+        await self.send(
+            client_id,
+            "status",
+            {"status": {"exec_info": {"queue_remaining": 0}}, "sid": client_id},
+        )
+        async for _ in ws:
+            pass
+        self.sockets.pop(client_id, None)
+        return ws
+
+    async def send(self, client_id, message_type, data):
+        ws = self.sockets.get(client_id)
+        if ws is not None and not ws.closed:
+            await ws.send_str(json.dumps({"type": message_type, "data": data}))
+
+    async def worker(self):
+        while True:
+            prompt_id, prompt, client_id = await self.queue.get()
+            if self.pending.pop(prompt_id, None) is None:
+                continue
+            self.running = prompt_id
+            self.interrupted = False
+            try:
+                await self.execute(prompt_id, prompt, client_id)
+            finally:
+                self.running = None
+            self.prompts_run += 1
+
+    async def execute(self, prompt_id, prompt, client_id):
+        await self.send(
+            client_id,
+            "execution_start",
+            {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)},
+        )
+        cached = self.cached_nodes(prompt)
+        await self.send(
+            client_id,
+            "execution_cached",
+            {
+                "nodes": sorted(cached),
+                "prompt_id": prompt_id,
+                "timestamp": int(time.time() * 1000),
+            },
+        )
+
+        outputs = {
+            node_id: self.cached_outputs[node_id]
+            for node_id in cached
+            if node_id in self.cached_outputs
+        }
+        executed = []
+        for node_id in execution_order(prompt):
+            if node_id in cached:
+                continue
+            node = prompt[node_id]
+            await self.send(
+                client_id,
+                "executing",
+                {"node": node_id, "display_node": node_id, "prompt_id": prompt_id},
+            )
+            if self.node_time:
+                await asyncio.sleep(self.node_time)
+
+            steps = node["inputs"].get("steps")
+            if isinstance(steps, int):
+                for step in range(1, steps + 1):
+                    if self.step_time:
+                        await asyncio.sleep(self.step_time)
+                    if self.interrupted:
+                        break
+                    await self.send(
+                        client_id,
+                        "progress",
+                        {
+                            "value": step,
+                            "max": steps,
+                            "prompt_id": prompt_id,
+                            "node": node_id,
+                        },
+                    )
+
+            class_type = node["class_type"]
+            if self.interrupted or class_type in self.fail_class_types:
+                self.update_cache(prompt, cached | set(executed), outputs)
+                await self.fail(prompt_id, prompt, client_id, node_id, executed)
+                return
+            executed.append(node_id)
+
+            if class_type in SAVE_NODE_CLASSES or class_type in PREVIEW_NODE_CLASSES:
+                output = {"images": self.save_images(prompt, node)}
+                outputs[node_id] = output
+                await self.send(
+                    client_id,
+                    "executed",
+                    {
+                        "node": node_id,
+                        "display_node": node_id,
+                        "output": output,
+                        "prompt_id": prompt_id,
+                    },
+                )
+
+        self.update_cache(prompt, cached | set(executed), outputs)
+        self.history[prompt_id] = {
+            "prompt": [self.prompts_run, prompt_id, prompt, {}, list(outputs)],
+            "outputs": outputs,
+            "status": {"status_str": "success", "completed": True, "messages": []},
+        }
+        await self.send(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+
+    # Nodes that ran in the last prompt with the same inputs, and whose
+    # upstream nodes are cached too
+    def cached_nodes(self, prompt):
+        cached = {}
+
+        def is_cached(node_id):
+            if node_id not in cached:
+                cached[node_id] = False
+                node = prompt[node_id]
+                cached[node_id] = self.cached_prompt.get(node_id) == node.get(
+                    "inputs"
+                ) and all(
+                    is_cached(value[0])
+                    for value in node.get("inputs", {}).values()
+                    if isinstance(value, list)
+                    and len(value) == 2
+                    and value[0] in prompt
+                )
+            return cached[node_id]
+
+        return {node_id for node_id in prompt if is_cached(node_id)}
+
+    # Only the results of the last prompt are kept, as in ComfyUI
+    def update_cache(self, prompt, done, outputs):
+        self.cached_prompt = {
+            node_id: json.loads(json.dumps(prompt[node_id].get("inputs")))
+            for node_id in done
+        }
+        self.cached_outputs = {
+            node_id: output for node_id, output in outputs.items() if node_id in done
+        }
+
+    async def fail(self, prompt_id, prompt, client_id, node_id, executed):
+        data = {
+            "prompt_id": prompt_id,
+            "node_id": node_id,
+            "node_type": prompt[node_id]["class_type"],
+            "executed": executed,
+        }
+        if self.interrupted:
+            message_type = "execution_interrupted"
+        else:
+            message_type = "execution_error"
+            data.update(
+                {
+                    "exception_message": "Simulated failure",
+                    "exception_type": "RuntimeError",
+                    "traceback": ["Simulated by the fake ComfyUI server"],
+                    "current_inputs": {},
+                    "current_outputs": {},
+                }
+            )
+        self.history[prompt_id] = {
+            "prompt": [self.prompts_run, prompt_id, prompt, {}, []],
+            "outputs": {},
+            "status": {
+                "status_str": "error",
+                "completed": False,
+                "messages": [[message_type, data]],
+            },
+        }
+        await self.send(client_id, message_type, data)
+        await self.send(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+
+    def save_images(self, prompt, node):
+        width, height, batch_size = image_size(prompt)
+        if node["class_type"] in SAVE_NODE_CLASSES:
+            output_type = "output"
+            directory = self.output_directory
+            prefix = node["inputs"].get("filename_prefix", "ComfyUI")
+        else:
+            output_type = "temp"
+            directory = self.temp_directory
+            prefix = "ComfyUI_temp"
+            batch_size = 1
+
+        subfolder = os.path.dirname(os.path.normpath(prefix))
+        prefix = os.path.basename(os.path.normpath(prefix))
+        os.makedirs(os.path.join(directory, subfolder), exist_ok=True)
+
+        images = []
+        for _ in range(batch_size):
+            counter = self.counters.get((directory, subfolder, prefix), 0) + 1
+            self.counters[(directory, subfolder, prefix)] = counter
+            filename = f"{prefix}_{counter:05}_.png"
+            with open(os.path.join(directory, subfolder, filename), "wb") as f:
+                f.write(self.placeholder_png(width, height))
+            images.append(
+                {"filename": filename, "subfolder": subfolder, "type": output_type}
+            )
+        return images
+
+    def placeholder_png(self, width, height):
+        if (width, height) not in self.images:
+            buffer = io.BytesIO()
+            Image.new("RGB", (width, height), (127, 127, 127)).save(
+                buffer, format="PNG"
+            )
+            self.images[(width, height)] = buffer.getvalue()
+        return self.images[(width, height)]
+
+    # Serves from a background thread, returns once the server is listening
+    def start(self, host="127.0.0.1", port=8188):
+        started = threading.Event()
+
+        def serve():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            runner = web.AppRunner(self.app())
+            self.loop.run_until_complete(runner.setup())
+            self.loop.run_until_complete(web.TCPSite(runner, host, port).start())
+            started.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=serve, daemon=True).start()
+        if not started.wait(timeout=10):
+            raise RuntimeError("Fake ComfyUI server did not start")
+        print(f"Fake ComfyUI server listening on {host}:{port}")
+        return self
+
+
+# Nodes in an order where every node comes after the nodes it takes inputs from
+def execution_order(prompt):
+    order = []
+    visited = set()
+
+    def visit(node_id):
+        if node_id in visited or node_id not in prompt:
+            return
+        visited.add(node_id)
+        for value in prompt[node_id].get("inputs", {}).values():
+            if (
+                isinstance(value, list)
+                and len(value) == 2
+                and isinstance(value[0], str)
+            ):
+                visit(value[0])
+        order.append(node_id)
+
+    for node_id in prompt:
+        visit(node_id)
+    return order
+
+
+def image_size(prompt):
+    width, height, batch_size = 512, 512, 1
+    for node in prompt.values():
+        inputs = node.get("inputs", {})
+        width = inputs.get("empty_latent_width", width)
+        height = inputs.get("empty_latent_height", height)
+        if isinstance(inputs.get("batch_size"), int):
+            batch_size = max(batch_size, inputs["batch_size"])
+    return width, height, batch_size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake ComfyUI server")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--output-directory", default="/tmp/outputs")
+    parser.add_argument("--temp-directory", default="ComfyUI/temp")
+    parser.add_argument("--node-time", type=float, default=0.0, help="Seconds per node")
+    parser.add_argument(
+        "--step-time", type=float, default=0.0, help="Seconds per sampler step"
+    )
+    parser.add_argument(
+        "--fail-class-types",
+        nargs="*",
+        default=[],
+        help="Node class types that raise an execution error",
+    )
+    args = parser.parse_args()
+
+    FakeComfyUI(
+        args.output_directory,
+        args.temp_directory,
+        args.node_time,
+        args.step_time,
+        args.fail_class_types,
+    ).start(port=args.port)
+    threading.Event().wait()
@@ -18,4 +18,5 @@ for key in data:
 with open('weights.json', 'w') as file:
     json.dump(data, file, indent=2)
 
+WeightsManifest.write_weights_index()
 WeightsManifest().write_supported_weights()
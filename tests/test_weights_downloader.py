@@ -0,0 +1,166 @@
+import contextlib
+import http.server
+import io
+import os
+import stat
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import weights_downloader
+from weights_manifest import WeightsManifest
+
+# Stands in for pget: fetches the tar at url and extracts it into dest
+FAKE_PGET = """#!{python}
+import sys, tarfile, urllib.request
+url, dest = sys.argv[-2:]
+with urllib.request.urlopen(url) as response:
+    tarfile.open(fileobj=response, mode="r|").extractall(dest)
+"""
+
+WEIGHTS = {"a.safetensors": 4, "b.safetensors": 3, "c.pth": 2, "d.pth": 1}
+
+
+# Serves each weight as a tar, slowly enough that concurrent callers overlap,
+# and counts the requests made for each file
+class WeightsHandler(http.server.BaseHTTPRequestHandler):
+    def tar(self):
+        name = os.path.basename(self.path)[: -len(".tar")]
+        data = b"x" * WEIGHTS[name] * 1024 * 1024
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        return buffer.getvalue()
+
+    def send_tar(self, body):
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path))
+        data = self.tar()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            time.sleep(0.3)
+            self.wfile.write(data)
+
+    def do_HEAD(self):
+        self.send_tar(body=False)
+
+    def do_GET(self):
+        self.send_tar(body=True)
+
+    def log_message(self, *args):
+        pass
+
+
+class WeightsDownloaderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        bin_directory = os.path.join(self.directory.name, "bin")
+        os.makedirs(bin_directory)
+        pget = os.path.join(bin_directory, "pget")
+        with open(pget, "w") as f:
+            f.write(FAKE_PGET.format(python=sys.executable))
+        os.chmod(pget, os.stat(pget).st_mode | stat.S_IEXEC)
+        path = mock.patch.dict(
+            os.environ, {"PATH": f"{bin_directory}:{os.environ['PATH']}"}
+        )
+        path.start()
+        self.addCleanup(path.stop)
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), WeightsHandler)
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        with mock.patch.object(
+            weights_downloader,
+            "WeightsManifest",
+            lambda: WeightsManifest(fetch_updates=False),
+        ), contextlib.redirect_stdout(io.StringIO()):
+            self.downloader = weights_downloader.WeightsDownloader(
+                max_concurrent_downloads=2
+            )
+        url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.weights_map = {
+            name: {"url": f"{url}/{name}.tar", "dest": self.directory.name}
+            for name in WEIGHTS
+        }
+        self.downloader.weights_map = self.weights_map
+
+    def tearDown(self):
+        self.downloader.executor.shutdown()
+        self.downloader.probe_executor.shutdown()
+        self.directory.cleanup()
+
+    def requests(self, method):
+        return sorted(
+            path for command, path in self.server.requests if command == method
+        )
+
+    def test_concurrent_callers_download_each_weight_once(self):
+        output = io.StringIO()
+        callers = [
+            threading.Thread(
+                target=self.downloader.download_weights_concurrently,
+                args=(weight_strs,),
+            )
+            for weight_strs in [
+                ["c.pth", "a.safetensors", "b.safetensors"],
+                ["b.safetensors", "c.pth", "d.pth"],
+            ]
+        ]
+        with contextlib.redirect_stdout(output):
+            for caller in callers:
+                caller.start()
+                time.sleep(0.1)
+            for caller in callers:
+                caller.join()
+
+        for name, megabytes in WEIGHTS.items():
+            path = os.path.join(self.directory.name, name)
+            self.assertEqual(os.path.getsize(path), megabytes * 1024 * 1024)
+        self.assertEqual(
+            self.requests("GET"), sorted(f"/{name}.tar" for name in WEIGHTS)
+        )
+        self.assertEqual(self.downloader.in_flight, {})
+
+        # The second caller waits on the two weights the first one started,
+        # and each summary only counts what that caller downloaded
+        summaries = sorted(
+            line for line in output.getvalue().splitlines() if "aggregate" in line
+        )
+        self.assertEqual(len(summaries), 2)
+        self.assertTrue(summaries[0].startswith("⌛️ Downloaded 1 weights, 1.00MB"))
+        self.assertTrue(
+            summaries[0].endswith("waited for 2 weights already downloading, 5.00MB")
+        )
+        self.assertTrue(summaries[1].startswith("⌛️ Downloaded 3 weights, 9.00MB"))
+        self.assertNotIn("waited", summaries[1])
+
+    def test_largest_first_and_nothing_when_present(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.downloader.download_weights_concurrently(list(WEIGHTS)[::-1])
+        self.assertEqual(self.requests("HEAD"), sorted(f"/{n}.tar" for n in WEIGHTS))
+        gets = [path for command, path in self.server.requests if command == "GET"]
+        # Two downloads run at a time, so the two largest start together
+        self.assertEqual(sorted(gets[:2]), ["/a.safetensors.tar", "/b.safetensors.tar"])
+
+        self.server.requests.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.downloader.download_weights_concurrently(list(WEIGHTS))
+        self.assertEqual(self.server.requests, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
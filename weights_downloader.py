@@ -1,16 +1,148 @@
 import subprocess
+import threading
 import time
 import os
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
 
-from weights_manifest import WeightsManifest
+from weights_manifest import WeightsManifest, BASE_URL
 
-BASE_URL = "https://weights.replicate.delivery/default/comfy-ui"
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("WEIGHTS_MAX_CONCURRENT_DOWNLOADS", 4))
+
+# Size probes are HEAD requests, they get their own pool so they never wait
+# behind downloads
+MAX_CONCURRENT_SIZE_PROBES = 8
 
 
 class WeightsDownloader:
-    def __init__(self):
+    def __init__(self, max_concurrent_downloads=MAX_CONCURRENT_DOWNLOADS):
         self.weights_manifest = WeightsManifest()
         self.weights_map = self.weights_manifest.weights_map
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrent_downloads,
+            thread_name_prefix="weights-download",
+        )
+        self.probe_executor = ThreadPoolExecutor(
+            max_workers=MAX_CONCURRENT_SIZE_PROBES,
+            thread_name_prefix="weights-size",
+        )
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        self.present_weights = {}
+
+    # Downloads many weights at once, at most max_concurrent_downloads at a
+    # time and largest first so the longest download is not left until last.
+    # Weights another caller is already downloading are waited on, not
+    # downloaded twice.
+    def download_weights_concurrently(self, weight_strs):
+        weight_strs = list(dict.fromkeys(weight_strs))
+        for weight_str in weight_strs:
+            self.check_weights_available(weight_str)
+
+        # Partially downloaded weights already exist on disk, so anything in
+        # flight is waited on rather than trusted
+        with self.in_flight_lock:
+            in_flight = set(self.in_flight)
+        directory_mtimes = {}
+        missing = [
+            w
+            for w in weight_strs
+            if w in in_flight or not self.weights_exist(w, directory_mtimes)
+        ]
+        if not missing:
+            return
+
+        # Weights already in flight are downloading, so there is no order
+        # to decide for them
+        start = time.time()
+        to_probe = [w for w in missing if w not in in_flight]
+        sizes = dict(zip(to_probe, self.probe_executor.map(self.remote_size, to_probe)))
+        missing.sort(key=lambda w: sizes.get(w, 0), reverse=True)
+        downloads = [self.submit_download(weight_str) for weight_str in missing]
+        wait([future for future, _ in downloads])
+
+        # Each caller reports the downloads it started, and separately the
+        # ones it waited on, so concurrent callers do not count a weight twice
+        downloaded = [
+            future.result()
+            for future, started in downloads
+            if started and future.result() is not None
+        ]
+        waited = [future.result() or 0 for future, started in downloads if not started]
+        elapsed_time = time.time() - start
+        total_megabytes = sum(downloaded) / (1024 * 1024)
+        summary = (
+            f"⌛️ Downloaded {len(downloaded)} weights, {total_megabytes:.2f}MB in {elapsed_time:.2f}s "
+            f"({total_megabytes / max(elapsed_time, 1e-6):.2f}MB/s aggregate)"
+        )
+        if waited:
+            summary += (
+                f", waited for {len(waited)} weights already downloading, "
+                f"{sum(waited) / (1024 * 1024):.2f}MB"
+            )
+        print(summary)
+
+    # Returns the download's future, and whether this call started it
+    def submit_download(self, weight_str):
+        with self.in_flight_lock:
+            future = self.in_flight.get(weight_str)
+            if future is not None:
+                return future, False
+            future = self.executor.submit(self.download_weights, weight_str)
+            self.in_flight[weight_str] = future
+            future.add_done_callback(
+                lambda _: self._clear_in_flight(weight_str, future)
+            )
+            return future, True
+
+    def _clear_in_flight(self, weight_str, future):
+        with self.in_flight_lock:
+            if self.in_flight.get(weight_str) is future:
+                del self.in_flight[weight_str]
+
+    def check_weights_available(self, weight_str):
+        if weight_str not in self.weights_map:
+            raise ValueError(
+                f"{weight_str} unavailable. View the list of available weights: https://github.com/fofr/cog-comfyui/blob/main/supported_weights.md"
+            )
+
+    # Weights seen on disk are remembered with the mtime of their directory.
+    # Adding or deleting a file changes that mtime, so one stat per directory
+    # is enough to trust the index instead of checking every file.
+    def weights_exist(self, weight_str, directory_mtimes=None):
+        path = f"{self.weights_map[weight_str]['dest']}/{weight_str}"
+        directory = os.path.dirname(path)
+
+        if directory_mtimes is not None and directory in directory_mtimes:
+            mtime = directory_mtimes[directory]
+        else:
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if directory_mtimes is not None:
+                directory_mtimes[directory] = mtime
+
+        if mtime is not None and self.present_weights.get(weight_str) == mtime:
+            return True
+
+        if mtime is not None and os.path.exists(path):
+            self.present_weights[weight_str] = mtime
+            return True
+
+        self.present_weights.pop(weight_str, None)
+        return False
+
+    # Used to schedule the largest downloads first, unknown sizes go last
+    def remote_size(self, weight_str):
+        request = urllib.request.Request(
+            self.weights_map[weight_str]["url"], method="HEAD"
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return int(response.headers.get("Content-Length") or 0)
+        except (OSError, ValueError):
+            return 0
 
     def download_weights(self, weight_str):
         if weight_str in self.weights_map:
@@ -18,7 +150,7 @@ class WeightsDownloader:
                 print(
                     f"⚠️  {weight_str} is for non-commercial use only. Unless you have obtained a commercial license.\nDetails: https://github.com/fofr/cog-comfyui/blob/main/weights_licenses.md"
                 )
-            self.download_if_not_exists(
+            return self.download_if_not_exists(
                 weight_str,
                 self.weights_map[weight_str]["url"],
                 self.weights_map[weight_str]["dest"],
@@ -37,7 +169,7 @@ class WeightsDownloader:
 
     def download_if_not_exists(self, weight_str, url, dest):
         if not os.path.exists(f"{dest}/{weight_str}"):
-            self.download(weight_str, url, dest)
+            return self.download(weight_str, url, dest)
 
     def download(self, weight_str, url, dest):
         if "/" in weight_str:
@@ -59,5 +191,6 @@ class WeightsDownloader:
             print(
                 f"⌛️ Downloaded {weight_str} in {elapsed_time:.2f}s, size: {file_size_megabytes:.2f}MB"
             )
+            return file_size_bytes
         except FileNotFoundError:
             print(f"Warning: Could not get the file size for {weight_str}")
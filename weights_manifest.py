@@ -1,95 +1,221 @@
-import subprocess
+import hashlib
+import threading
 import time
 import os
 import json
+import urllib.error
+import urllib.request
+from collections.abc import Mapping
 
 from helpers.ComfyUI_Controlnet_Aux import ComfyUI_Controlnet_Aux
 from helpers.ComfyUI_AnimateDiff_Evolved import ComfyUI_AnimateDiff_Evolved
 
-UPDATED_WEIGHTS_MANIFEST_URL = f"https://weights.replicate.delivery/default/comfy-ui/weights.json?cache_bypass={int(time.time())}"
+# Can be pointed at a local file server when testing downloads
+BASE_URL = os.environ.get(
+    "WEIGHTS_BASE_URL", "https://weights.replicate.delivery/default/comfy-ui"
+)
+UPDATED_WEIGHTS_MANIFEST_URL = (
+    f"{BASE_URL}/weights.json?cache_bypass={int(time.time())}"
+)
 UPDATED_WEIGHTS_MANIFEST_PATH = "updated_weights.json"
+UPDATED_WEIGHTS_MANIFEST_TTL = 6 * 60 * 60
 WEIGHTS_MANIFEST_PATH = "weights.json"
 
-BASE_URL = "https://weights.replicate.delivery/default/comfy-ui"
+# Generated from weights.json by scripts/sort_weights.py
+WEIGHTS_INDEX_PATH = "weights_index.json"
+
 BASE_PATH = "ComfyUI/models"
 
 
-class WeightsManifest:
-    def __init__(self):
-        self.weights_manifest = self._load_weights_manifest()
-        self.weights_map = self._initialize_weights_map()
+# Read-only view of the weights index that looks like the old weights_map:
+# weights_map[name] gives {"url": ..., "dest": ...}.
+# Names missing from the precompiled index are looked up again once the
+# remote manifest update has finished.
+class WeightsMap(Mapping):
+    def __init__(self, manifest):
+        self.manifest = manifest
 
-    def _load_weights_manifest(self):
-        self._download_updated_weights_manifest()
-        return self._merge_manifests()
+    def _entry(self, weight_str):
+        entry = self.manifest.index["weights"].get(weight_str)
+        if entry is None:
+            self.manifest.wait_for_updates()
+            entry = self.manifest.updated_weights.get(weight_str)
+        return entry
 
-    def _download_updated_weights_manifest(self):
-        if not os.path.exists(UPDATED_WEIGHTS_MANIFEST_PATH):
-            print(
-                f"Downloading updated weights manifest from {UPDATED_WEIGHTS_MANIFEST_URL}"
-            )
-            start = time.time()
-            subprocess.check_call(
-                [
-                    "pget",
-                    "--log-level",
-                    "warn",
-                    "-f",
-                    UPDATED_WEIGHTS_MANIFEST_URL,
-                    UPDATED_WEIGHTS_MANIFEST_PATH,
-                ],
-                close_fds=False,
-            )
-            print(
-                f"Downloading {UPDATED_WEIGHTS_MANIFEST_URL} took: {(time.time() - start):.2f}s"
+    def __getitem__(self, weight_str):
+        entry = self._entry(weight_str)
+        if entry is None:
+            raise KeyError(weight_str)
+        url_path, dest = entry
+        return {"url": f"{BASE_URL}/{url_path}", "dest": dest}
+
+    def __contains__(self, weight_str):
+        return self._entry(weight_str) is not None
+
+    def __iter__(self):
+        self.manifest.wait_for_updates()
+        yield from self.manifest.index["weights"]
+        yield from self.manifest.updated_weights
+
+    def __len__(self):
+        self.manifest.wait_for_updates()
+        return len(self.manifest.index["weights"]) + len(self.manifest.updated_weights)
+
+
+class WeightsManifest:
+    def __init__(self, fetch_updates=True):
+        self.index = self._load_weights_index()
+        self.weights_map = WeightsMap(self)
+        self.updated_manifest = {}
+        self.updated_weights = {}
+        self.update_thread = None
+
+        if fetch_updates:
+            self.update_thread = threading.Thread(
+                target=self._update_from_remote, daemon=True
             )
-        else:
-            print("Updated weights manifest file already exists")
+            self.update_thread.start()
+
+        print(f"{len(self.index['weights'])} weights available")
 
-    def _merge_manifests(self):
+    @property
+    def weights_manifest(self):
+        self.wait_for_updates()
+        return self._merge_manifests(self.index["manifest"], self.updated_manifest)
+
+    def wait_for_updates(self):
+        if self.update_thread is not None:
+            self.update_thread.join()
+
+    @staticmethod
+    def _read_original_manifest():
         if os.path.exists(WEIGHTS_MANIFEST_PATH):
-            with open(WEIGHTS_MANIFEST_PATH, "r") as f:
-                original_manifest = json.load(f)
-        else:
-            original_manifest = {}
+            with open(WEIGHTS_MANIFEST_PATH, "rb") as f:
+                data = f.read()
+            return json.loads(data), hashlib.sha1(data).hexdigest()
+        return {}, None
 
-        with open(UPDATED_WEIGHTS_MANIFEST_PATH, "r") as f:
-            updated_manifest = json.load(f)
-
-        for key in updated_manifest:
-            if key in original_manifest:
-                for item in updated_manifest[key]:
-                    if item not in original_manifest[key]:
-                        print(f"Adding {item} to {key}")
-                        original_manifest[key].append(item)
-            else:
-                original_manifest[key] = updated_manifest[key]
+    def _load_weights_index(self):
+        manifest, manifest_hash = self._read_original_manifest()
 
-        return original_manifest
+        if os.path.exists(WEIGHTS_INDEX_PATH):
+            with open(WEIGHTS_INDEX_PATH, "r") as f:
+                index = json.load(f)
+            if index.get("manifest_hash") == manifest_hash:
+                return index
 
-    def _generate_weights_map(self, keys, dest):
+        print(
+            f"{WEIGHTS_INDEX_PATH} is missing or out of date, run scripts/sort_weights.py to regenerate it"
+        )
+        return self.build_weights_index(manifest, manifest_hash)
+
+    @staticmethod
+    def _weights_entries(names, dest):
+        return {name: [f"{dest}/{name}.tar", f"{BASE_PATH}/{dest}"] for name in names}
+
+    @staticmethod
+    def _custom_node_entries():
+        entries = {}
+        for weights_map in [
+            ComfyUI_Controlnet_Aux.weights_map(""),
+            ComfyUI_AnimateDiff_Evolved.weights_map(""),
+        ]:
+            for name, weight in weights_map.items():
+                entries[name] = [weight["url"].lstrip("/"), weight["dest"]]
+        return entries
+
+    @staticmethod
+    def build_weights_index(manifest, manifest_hash=None):
+        weights = {}
+        for key, names in manifest.items():
+            if key.isupper():
+                weights.update(WeightsManifest._weights_entries(names, key.lower()))
+        weights.update(WeightsManifest._custom_node_entries())
         return {
-            key: {
-                "url": f"{BASE_URL}/{dest}/{key}.tar",
-                "dest": f"{BASE_PATH}/{dest}",
-            }
-            for key in keys
+            "manifest_hash": manifest_hash,
+            "manifest": manifest,
+            "weights": weights,
         }
 
-    def _initialize_weights_map(self):
-        weights_map = {}
-        for key in self.weights_manifest.keys():
+    @staticmethod
+    def write_weights_index():
+        manifest, manifest_hash = WeightsManifest._read_original_manifest()
+        index = WeightsManifest.build_weights_index(manifest, manifest_hash)
+        with open(WEIGHTS_INDEX_PATH, "w") as f:
+            json.dump(index, f, separators=(",", ":"), sort_keys=True)
+        print(f"Wrote {len(index['weights'])} weights to {WEIGHTS_INDEX_PATH}")
+
+    # Runs in the background so startup never waits on the network. Only
+    # lookups for weights missing from the precompiled index wait for it.
+    def _update_from_remote(self):
+        try:
+            updated_manifest = self._download_updated_weights_manifest()
+        except Exception as e:
+            print(f"Could not update weights manifest: {e}")
+            return
+
+        updated_weights = {}
+        for key, names in updated_manifest.items():
             if key.isupper():
-                weights_map.update(
-                    self._generate_weights_map(self.weights_manifest[key], key.lower())
-                )
-        weights_map.update(ComfyUI_Controlnet_Aux.weights_map(BASE_URL))
-        weights_map.update(ComfyUI_AnimateDiff_Evolved.weights_map(BASE_URL))
-        print("Allowed weights:")
-        for weight in weights_map.keys():
-            print(weight)
+                for name, entry in self._weights_entries(names, key.lower()).items():
+                    if name not in self.index["weights"]:
+                        updated_weights[name] = entry
+
+        self.updated_manifest = updated_manifest
+        self.updated_weights = updated_weights
+        if updated_weights:
+            print(f"Added {len(updated_weights)} weights from the updated manifest")
+
+    def _download_updated_weights_manifest(self):
+        etag_path = f"{UPDATED_WEIGHTS_MANIFEST_PATH}.etag"
+        if os.path.exists(UPDATED_WEIGHTS_MANIFEST_PATH):
+            age = time.time() - os.path.getmtime(UPDATED_WEIGHTS_MANIFEST_PATH)
+            if age < UPDATED_WEIGHTS_MANIFEST_TTL:
+                with open(UPDATED_WEIGHTS_MANIFEST_PATH, "r") as f:
+                    return json.load(f)
 
-        return weights_map
+        headers = {}
+        if os.path.exists(UPDATED_WEIGHTS_MANIFEST_PATH) and os.path.exists(etag_path):
+            with open(etag_path, "r") as f:
+                headers["If-None-Match"] = f.read().strip()
+
+        start = time.time()
+        request = urllib.request.Request(UPDATED_WEIGHTS_MANIFEST_URL, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                data = response.read()
+                etag = response.headers.get("ETag")
+            with open(UPDATED_WEIGHTS_MANIFEST_PATH, "wb") as f:
+                f.write(data)
+            if etag:
+                with open(etag_path, "w") as f:
+                    f.write(etag)
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise
+            # Not modified, the copy on disk is fresh for another TTL
+            os.utime(UPDATED_WEIGHTS_MANIFEST_PATH)
+
+        print(
+            f"Checking {UPDATED_WEIGHTS_MANIFEST_URL} took: {(time.time() - start):.2f}s"
+        )
+        with open(UPDATED_WEIGHTS_MANIFEST_PATH, "r") as f:
+            return json.load(f)
+
+    def _merge_manifests(self, original_manifest, updated_manifest):
+        merged_manifest = {key: list(names) for key, names in original_manifest.items()}
+
+        for key, names in updated_manifest.items():
+            if key in merged_manifest:
+                existing = set(merged_manifest[key])
+                for item in names:
+                    if item not in existing:
+                        existing.add(item)
+                        merged_manifest[key].append(item)
+            else:
+                merged_manifest[key] = list(names)
+
+        return merged_manifest
 
     def non_commercial_weights(self):
         return [
@@ -108,19 +234,18 @@ class WeightsManifest:
         return weight_str in self.non_commercial_weights()
 
     def write_supported_weights(self):
+        weights_manifest = self.weights_manifest
         weight_lists = {
-            "Checkpoints": self.weights_manifest.get("CHECKPOINTS", []),
-            "Upscale models": self.weights_manifest.get("UPSCALE_MODELS", []),
-            "CLIP Vision": self.weights_manifest.get("CLIP_VISION", []),
-            "LORAs": self.weights_manifest.get("LORAS", []),
-            "IPAdapter": self.weights_manifest.get("IPADAPTER", []),
-            "ControlNet": self.weights_manifest.get("CONTROLNET", []),
-            "VAE": self.weights_manifest.get("VAE", []),
-            "PhotoMaker": self.weights_manifest.get("PHOTOMAKER", []),
-            "Face restoration models": self.weights_manifest.get(
-                "FACERESTORE_MODELS", []
-            ),
-            "Face detection models": self.weights_manifest.get("FACEDETECTION", []),
+            "Checkpoints": weights_manifest.get("CHECKPOINTS", []),
+            "Upscale models": weights_manifest.get("UPSCALE_MODELS", []),
+            "CLIP Vision": weights_manifest.get("CLIP_VISION", []),
+            "LORAs": weights_manifest.get("LORAS", []),
+            "IPAdapter": weights_manifest.get("IPADAPTER", []),
+            "ControlNet": weights_manifest.get("CONTROLNET", []),
+            "VAE": weights_manifest.get("VAE", []),
+            "PhotoMaker": weights_manifest.get("PHOTOMAKER", []),
+            "Face restoration models": weights_manifest.get("FACERESTORE_MODELS", []),
+            "Face detection models": weights_manifest.get("FACEDETECTION", []),
             "AnimateDiff": ComfyUI_AnimateDiff_Evolved.models(),
             "AnimateDiff LORAs": ComfyUI_AnimateDiff_Evolved.loras(),
             "ControlNet Preprocessors": sorted(